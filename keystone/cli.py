@@ -18,6 +18,7 @@ from __future__ import absolute_import
 
 import sys
 import textwrap
+import time
 
 from keystone import config
 from keystone.common import openssl
@@ -120,11 +121,26 @@ class ImportNovaAuth(BaseApp):
         nova.import_auth(dump_data)
 
 
+class TokenFlush(BaseApp):
+    """Purge expired tokens from the token backend."""
+
+    name = 'token_flush'
+
+    def main(self):
+        driver = importutils.import_object(CONF.token.driver)
+        start = time.time()
+        count = driver.flush_expired_tokens()
+        elapsed = time.time() - start
+        print 'Deleted %d expired tokens in %.2fs (%.1f tokens/s)' % (
+            count, elapsed, count / elapsed if elapsed else count)
+
+
 CMDS = {'db_sync': DbSync,
         'import_legacy': ImportLegacy,
         'export_legacy_catalog': ExportLegacyCatalog,
         'import_nova_auth': ImportNovaAuth,
         'pki_setup': PKISetup,
+        'token_flush': TokenFlush,
         }
 
 
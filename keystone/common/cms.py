@@ -1,11 +1,18 @@
+import base64
 import hashlib
+import zlib
 
 from keystone.common import logging
+from keystone.common import workers
 
 
 subprocess = None
 LOG = logging.getLogger(__name__)
 PKI_ANS1_PREFIX = 'MII'
+PKIZ_PREFIX = 'PKIZ_'
+# digest of signatures; given explicitly so that every engine uses the same
+# one instead of its library's default (sha1 in M2Crypto)
+SIGNING_DIGEST = 'sha256'
 
 
 def _ensure_subprocess():
@@ -24,26 +31,238 @@ def _ensure_subprocess():
             import subprocess
 
 
+class SubprocessEngine(object):
+    """Forks ``openssl cms`` for every signature and verification."""
+
+    def __init__(self, **options):
+        pass
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+    def sign(self, text, signing_cert_file_name, signing_key_file_name):
+        _ensure_subprocess()
+        process = subprocess.Popen(["openssl", "cms", "-sign",
+                                    "-signer", signing_cert_file_name,
+                                    "-inkey", signing_key_file_name,
+                                    "-md", SIGNING_DIGEST,
+                                    "-outform", "PEM",
+                                    "-nosmimecap", "-nodetach",
+                                    "-nocerts", "-noattr"],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, err = process.communicate(text)
+        retcode = process.poll()
+        if retcode or "Error" in err:
+            LOG.error('Signing error: %s' % err)
+            raise subprocess.CalledProcessError(retcode, "openssl")
+        return output
+
+    def verify(self, formatted, signing_cert_file_name, ca_file_name):
+        _ensure_subprocess()
+        process = subprocess.Popen(["openssl", "cms", "-verify",
+                                    "-certfile", signing_cert_file_name,
+                                    "-CAfile", ca_file_name,
+                                    "-inform", "PEM",
+                                    "-nosmimecap", "-nodetach",
+                                    "-nocerts", "-noattr"],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, err = process.communicate(formatted)
+        retcode = process.poll()
+        if retcode:
+            LOG.error('Verify error: %s' % err)
+            raise subprocess.CalledProcessError(retcode, "openssl",
+                                                output=err)
+        return output
+
+
+class M2CryptoEngine(object):
+    """Signs and verifies in process with M2Crypto.
+
+    The signing key and certificates are read from disk the first time they
+    are used and kept for the lifetime of the process. Documents are signed
+    with the same digest and options as ``openssl cms -sign -nosmimecap
+    -nodetach -nocerts -noattr``, so the output is identical to
+    SubprocessEngine's.
+
+    """
+
+    def __init__(self, **options):
+        import M2Crypto
+        self.m2 = M2Crypto
+        self._signers = {}
+        self._verifiers = {}
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+    def _error(self, action, e):
+        _ensure_subprocess()
+        LOG.error('%s error: %s' % (action, e))
+        return subprocess.CalledProcessError(1, "M2Crypto", output=str(e))
+
+    def _signer(self, signing_cert_file_name, signing_key_file_name):
+        key = (signing_cert_file_name, signing_key_file_name)
+        if key not in self._signers:
+            signer = self.m2.SMIME.SMIME()
+            signer.load_key(signing_key_file_name, signing_cert_file_name)
+            self._signers[key] = signer
+        return self._signers[key]
+
+    def _verifier(self, signing_cert_file_name, ca_file_name):
+        key = (signing_cert_file_name, ca_file_name)
+        if key not in self._verifiers:
+            verifier = self.m2.SMIME.SMIME()
+            certs = self.m2.X509.X509_Stack()
+            certs.push(self.m2.X509.load_cert(signing_cert_file_name))
+            verifier.set_x509_stack(certs)
+            store = self.m2.X509.X509_Store()
+            store.load_info(ca_file_name)
+            verifier.set_x509_store(store)
+            self._verifiers[key] = verifier
+        return self._verifiers[key]
+
+    def sign(self, text, signing_cert_file_name, signing_key_file_name):
+        SMIME = self.m2.SMIME
+        try:
+            signer = self._signer(signing_cert_file_name,
+                                  signing_key_file_name)
+            pkcs7 = signer.sign(self.m2.BIO.MemoryBuffer(text),
+                                SMIME.PKCS7_NOCERTS | SMIME.PKCS7_NOATTR,
+                                algo=SIGNING_DIGEST)
+        except (SMIME.SMIME_Error, SMIME.PKCS7_Error), e:
+            raise self._error('Signing', e)
+        der = self.m2.BIO.MemoryBuffer()
+        pkcs7.write_der(der)
+        return token_to_cms(base64.b64encode(der.read()))
+
+    def verify(self, formatted, signing_cert_file_name, ca_file_name):
+        SMIME = self.m2.SMIME
+        der = _cms_to_der(formatted)
+        try:
+            verifier = self._verifier(signing_cert_file_name, ca_file_name)
+            pkcs7 = SMIME.load_pkcs7_bio_der(self.m2.BIO.MemoryBuffer(der))
+            return verifier.verify(pkcs7)
+        except (SMIME.SMIME_Error, SMIME.PKCS7_Error), e:
+            raise self._error('Verify', e)
+
+
+class PoolEngine(object):
+    """Hands CMS operations to a pool of long-lived worker processes.
+
+    Each worker is a small python process which signs and verifies with
+    M2Crypto, keeping the keys and certificates loaded between jobs, so that
+    keystone neither forks nor holds its interpreter lock while signing.
+    Jobs queued while a worker is busy are sent to it together as one batch
+    on its next round trip. A job which gets no answer within ``timeout``
+    seconds fails.
+
+    Requires M2Crypto: workers forking openssl would be no faster than the
+    subprocess engine.
+
+    """
+
+    def __init__(self, pool_size=2, batch_size=16, timeout=60, **options):
+        # fail here, so that set_engine falls back, rather than in the workers
+        import M2Crypto
+        self.pool_size = pool_size
+        self._pool = workers.WorkerPool('keystone.common.cms', 'worker_main',
+                                        pool_size, batch_size=batch_size,
+                                        timeout=timeout)
+
+    def _submit(self, request):
+        try:
+            return self._pool.submit(request).encode('utf-8')
+        except workers.WorkerError, e:
+            LOG.error('CMS worker error: %s' % e)
+            _ensure_subprocess()
+            raise subprocess.CalledProcessError(1, "openssl", output=str(e))
+
+    def sign(self, text, signing_cert_file_name, signing_key_file_name):
+        return self._submit(['sign', text, signing_cert_file_name,
+                             signing_key_file_name])
+
+    def verify(self, formatted, signing_cert_file_name, ca_file_name):
+        return self._submit(['verify', formatted, signing_cert_file_name,
+                             ca_file_name])
+
+    def stats(self):
+        return dict(self._pool.stats(), pool_size=self.pool_size)
+
+    def close(self):
+        """Stops the worker threads and processes once the queue is drained."""
+        self._pool.close()
+
+
+def worker_main():
+    """Serves PoolEngine jobs, one JSON encoded batch per line of stdin."""
+    engine = M2CryptoEngine()
+
+    def run(job):
+        action, args = job[0], [arg.encode('utf-8') for arg in job[1:]]
+        return getattr(engine, action)(*args)
+
+    # M2Crypto objects are not shared between threads; the pool's
+    # parallelism comes from its worker processes
+    workers.serve(run)
+
+
+ENGINES = {'subprocess': SubprocessEngine,
+           'm2crypto': M2CryptoEngine,
+           'pool': PoolEngine}
+_engine = None
+
+
+def set_engine(name, **options):
+    """Selects the engine used to sign and verify CMS documents.
+
+    Falls back to forking openssl if the engine's library is not installed.
+    The engine being replaced is closed.
+
+    """
+    global _engine
+    if name not in ENGINES:
+        raise ValueError('Unknown CMS engine: %s' % name)
+    if isinstance(_engine, ENGINES[name]):
+        return
+    try:
+        engine = ENGINES[name](**options)
+    except ImportError, e:
+        LOG.warning('Unable to load CMS engine %s, falling back to openssl'
+                    ' subprocesses: %s' % (name, e))
+        engine = SubprocessEngine()
+    if _engine is not None:
+        _engine.close()
+    _engine = engine
+
+
+def get_engine():
+    if _engine is None:
+        set_engine('subprocess')
+    return _engine
+
+
+def _cms_to_der(formatted):
+    return base64.b64decode(''.join(line
+                                    for line in formatted.splitlines()
+                                    if not line.startswith('-----')))
+
+
 def cms_verify(formatted, signing_cert_file_name, ca_file_name):
     """
         verifies the signature of the contents IAW CMS syntax
     """
-    _ensure_subprocess()
-    process = subprocess.Popen(["openssl", "cms", "-verify",
-                                "-certfile", signing_cert_file_name,
-                                "-CAfile", ca_file_name,
-                                "-inform", "PEM",
-                                "-nosmimecap", "-nodetach",
-                                "-nocerts", "-noattr"],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    output, err = process.communicate(formatted)
-    retcode = process.poll()
-    if retcode:
-        LOG.error('Verify error: %s' % err)
-        raise subprocess.CalledProcessError(retcode, "openssl", output=err)
-    return output
+    return get_engine().verify(formatted, signing_cert_file_name,
+                               ca_file_name)
 
 
 def token_to_cms(signed_text):
@@ -118,22 +337,8 @@ def cms_sign_text(text, signing_cert_file_name, signing_key_file_name):
     Produces a Base64 encoding of a DER formatted CMS Document
     http://en.wikipedia.org/wiki/Cryptographic_Message_Syntax
     """
-    _ensure_subprocess()
-    process = subprocess.Popen(["openssl", "cms", "-sign",
-                                "-signer", signing_cert_file_name,
-                                "-inkey", signing_key_file_name,
-                                "-outform", "PEM",
-                                "-nosmimecap", "-nodetach",
-                                "-nocerts", "-noattr"],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    output, err = process.communicate(text)
-    retcode = process.poll()
-    if retcode or "Error" in err:
-        LOG.error('Signing error: %s' % err)
-        raise subprocess.CalledProcessError(retcode, "openssl")
-    return output
+    return get_engine().sign(text, signing_cert_file_name,
+                             signing_key_file_name)
 
 
 def cms_sign_token(text, signing_cert_file_name, signing_key_file_name):
@@ -141,6 +346,37 @@ def cms_sign_token(text, signing_cert_file_name, signing_key_file_name):
     return cms_to_token(output)
 
 
+def pkiz_sign(text, signing_cert_file_name, signing_key_file_name):
+    """Signs a document and returns it as a compressed token.
+
+    The DER encoded CMS document is deflated and url safe base64 encoded
+    behind PKIZ_PREFIX, which makes catalog bearing tokens several times
+    smaller than their PKI equivalent.
+
+    """
+    output = cms_sign_text(text, signing_cert_file_name, signing_key_file_name)
+    return PKIZ_PREFIX + base64.urlsafe_b64encode(
+        zlib.compress(_cms_to_der(output)))
+
+
+def pkiz_to_cms(token):
+    """Inflates a compressed token back into a PEM formatted CMS document.
+
+    :raises: ValueError if the token is not a valid compressed token
+
+    """
+    try:
+        der = zlib.decompress(
+            base64.urlsafe_b64decode(str(token[len(PKIZ_PREFIX):])))
+    except (TypeError, zlib.error), e:
+        raise ValueError('Invalid compressed token: %s' % e)
+    return token_to_cms(base64.b64encode(der))
+
+
+def is_pkiz_token(token):
+    return token[:len(PKIZ_PREFIX)] == PKIZ_PREFIX
+
+
 def cms_to_token(cms_text):
 
     start_delim = "-----BEGIN CMS-----"
@@ -156,12 +392,12 @@ def cms_to_token(cms_text):
 
 def cms_hash_token(token_id):
     """
-    return: for ans1_token, returns the hash of the passed in token
-            otherwise, returns what it was passed in.
+    return: for ans1 and compressed tokens, returns the hash of the passed in
+            token otherwise, returns what it was passed in.
     """
     if token_id is None:
         return None
-    if is_ans1_token(token_id):
+    if is_ans1_token(token_id) or is_pkiz_token(token_id):
         hasher = hashlib.md5()
         hasher.update(token_id)
         return hasher.hexdigest()
@@ -43,8 +43,21 @@ Column = sql.Column
 String = sql.String
 ForeignKey = sql.ForeignKey
 DateTime = sql.DateTime
+Integer = sql.Integer
 IntegrityError = sql.exc.IntegrityError
+OperationalError = sql.exc.OperationalError
+DBAPIError = sql.exc.DBAPIError
 Boolean = sql.Boolean
+and_ = sql.and_
+or_ = sql.or_
+not_ = sql.not_
+null = sql.null
+Table = sql.Table
+MetaData = sql.MetaData
+select = sql.select
+union_all = sql.union_all
+literal = sql.literal
+func = sql.func
 
 
 def set_global_engine(engine):
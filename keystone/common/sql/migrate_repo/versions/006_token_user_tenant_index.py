@@ -0,0 +1,85 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import json
+
+import migrate
+import sqlalchemy as sql
+
+
+# number of token rows backfilled per transaction
+BATCH_SIZE = 1000
+
+
+def _backfill(migrate_engine, token):
+    """Copy the user and tenant ids out of the extra blob.
+
+    Only tokens which may still be listed (i.e. have not expired yet) are
+    backfilled; rows are walked in primary key order so that each batch is a
+    short transaction and never holds locks on the entire table.
+
+    """
+    now = datetime.datetime.utcnow()
+    last_id = ''
+    while True:
+        query = sql.select([token.c.id, token.c.extra])
+        query = query.where(token.c.id > last_id)
+        query = query.where(token.c.expires > now)
+        query = query.order_by(token.c.id).limit(BATCH_SIZE)
+        rows = migrate_engine.execute(query).fetchall()
+        if not rows:
+            break
+
+        connection = migrate_engine.connect()
+        transaction = connection.begin()
+        for token_id, extra in rows:
+            extra = json.loads(extra) if extra else {}
+            user = extra.get('user') or {}
+            tenant = extra.get('tenant') or {}
+            connection.execute(token.update()
+                               .where(token.c.id == token_id)
+                               .values(user_id=user.get('id'),
+                                       tenant_id=tenant.get('id')))
+        transaction.commit()
+        connection.close()
+        last_id = rows[-1][0]
+
+
+def upgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+    token = sql.Table('token', meta, autoload=True)
+
+    token.create_column(sql.Column('user_id', sql.String(64)))
+    token.create_column(sql.Column('tenant_id', sql.String(64)))
+
+    token = sql.Table('token', sql.MetaData(bind=migrate_engine),
+                      autoload=True)
+    sql.Index('ix_token_user_id', token.c.user_id).create()
+    sql.Index('ix_token_tenant_id', token.c.tenant_id).create()
+
+    _backfill(migrate_engine, token)
+
+
+def downgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+    token = sql.Table('token', meta, autoload=True)
+    sql.Index('ix_token_user_id', token.c.user_id).drop()
+    sql.Index('ix_token_tenant_id', token.c.tenant_id).drop()
+    token.drop_column('user_id')
+    token.drop_column('tenant_id')
@@ -0,0 +1,38 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sqlalchemy as sql
+
+
+def upgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+
+    generation_table = sql.Table(
+        'revocation_generation',
+        meta,
+        sql.Column('id', sql.String(64), primary_key=True),
+        sql.Column('generation', sql.Integer(), nullable=False))
+    generation_table.create(migrate_engine, checkfirst=True)
+    migrate_engine.execute(
+        generation_table.insert().values(id='token', generation=0))
+
+
+def downgrade(migrate_engine):
+    meta = sql.MetaData()
+    meta.bind = migrate_engine
+    generation_table = sql.Table('revocation_generation', meta, autoload=True)
+    generation_table.drop()
@@ -22,7 +22,9 @@ import base64
 import hashlib
 import hmac
 import json
+import math
 import os
+import struct
 import subprocess
 import time
 import urllib
@@ -30,11 +32,14 @@ import urllib
 import passlib.hash
 
 from keystone.common import logging
+from keystone.common import workers
 from keystone import config
+from keystone.openstack.common import timeutils
 
 
 CONF = config.CONF
 config.register_int('crypt_strength', default=40000)
+config.register_int('crypt_pool_size', default=0)
 
 LOG = logging.getLogger(__name__)
 
@@ -174,13 +179,87 @@ def hash_ldap_user_password(user):
         return dict(user, password=ldap_hash_password(password))
 
 
+def _crypt(action, password_utf8, arg):
+    if action == 'hash':
+        return passlib.hash.sha512_crypt.encrypt(password_utf8, rounds=arg)
+    return passlib.hash.sha512_crypt.verify(password_utf8, arg)
+
+
+class CryptPool(object):
+    """Runs sha512_crypt in a pool of long-lived worker processes.
+
+    crypt holds the interpreter lock for the whole computation, so hashing
+    in keystone itself stalls every other request of the process. Workers
+    are fed over pipes, which eventlet waits on without blocking the hub,
+    and hash passwords on as many cores as there are workers.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pool = workers.WorkerPool('keystone.common.utils',
+                                        'crypt_worker_main', size)
+
+    def run(self, action, password_utf8, arg):
+        """Returns _crypt(action, password_utf8, arg), from a worker.
+
+        Falls back to computing it in process if the worker failed.
+
+        """
+        try:
+            result = self._pool.submit(
+                [action, password_utf8.decode('utf-8'), arg])
+        except workers.WorkerError:
+            return _crypt(action, password_utf8, arg)
+        if isinstance(result, unicode):
+            return result.encode('utf-8')
+        return result
+
+    def close(self):
+        """Stops the worker threads and processes."""
+        self._pool.close()
+
+
+def crypt_worker_main():
+    """Serves CryptPool jobs, one JSON encoded batch per line of stdin."""
+    def run(job):
+        action, password, arg = job
+        return _crypt(action, password.encode('utf-8'), arg)
+
+    workers.serve(run)
+
+
+_CRYPT_POOL = None
+
+
+def crypt_pool():
+    """Returns the process-wide crypt pool, or None if it is disabled.
+
+    The pool is rebuilt whenever ``crypt_pool_size`` changes.
+
+    """
+    global _CRYPT_POOL
+    if _CRYPT_POOL is not None and _CRYPT_POOL.size != CONF.crypt_pool_size:
+        _CRYPT_POOL.close()
+        _CRYPT_POOL = None
+    if _CRYPT_POOL is None and CONF.crypt_pool_size > 0:
+        _CRYPT_POOL = CryptPool(CONF.crypt_pool_size)
+    return _CRYPT_POOL
+
+
+def _run_crypt(action, password_utf8, arg):
+    pool = crypt_pool()
+    if pool is None:
+        return _crypt(action, password_utf8, arg)
+    return pool.run(action, password_utf8, arg)
+
+
 def hash_password(password):
     """Hash a password. Hard."""
     password_utf8 = trunc_password(password).encode('utf-8')
     if passlib.hash.sha512_crypt.identify(password_utf8):
         return password_utf8
-    h = passlib.hash.sha512_crypt.encrypt(password_utf8,
-                                          rounds=CONF.crypt_strength)
+    h = _run_crypt('hash', password_utf8, CONF.crypt_strength)
     return h
 
 
@@ -208,7 +287,7 @@ def check_password(password, hashed):
     if password is None:
         return False
     password_utf8 = trunc_password(password).encode('utf-8')
-    return passlib.hash.sha512_crypt.verify(password_utf8, hashed)
+    return _run_crypt('verify', password_utf8, hashed)
 
 
 # From python 2.7
@@ -284,6 +363,156 @@ def auth_str_equal(provided, known):
     return (p_len == k_len) & (result == 0)
 
 
+class LRUCache(object):
+    """A size bounded, least recently used cache of expiring entries.
+
+    Entries are kept in a circular doubly linked list ordered from the most
+    to the least recently used, so that lookups, insertions and evictions
+    are all O(1). Hits and misses are counted to help size the cache.
+
+    """
+
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+        del self._entries[link[self.KEY]]
+
+    def _link(self, link):
+        root = self._root
+        link[self.PREV] = root
+        link[self.NEXT] = root[self.NEXT]
+        root[self.NEXT][self.PREV] = link
+        root[self.NEXT] = link
+        self._entries[link[self.KEY]] = link
+
+    def get(self, key):
+        """Returns the cached value, or None if missing or expired."""
+        link = self._entries.get(key)
+        if link is not None and (link[self.EXPIRES] is None or
+                                 link[self.EXPIRES] > timeutils.utcnow()):
+            self._unlink(link)
+            self._link(link)
+            self.hits += 1
+            return link[self.VALUE]
+        if link is not None:
+            self._unlink(link)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, expires=None):
+        """Caches a value, optionally until a naive utc datetime."""
+        if key in self._entries:
+            self._unlink(self._entries[key])
+        self._link([None, None, key, value, expires])
+        while len(self._entries) > self.max_size:
+            self._unlink(self._root[self.PREV])
+
+    def delete(self, key):
+        link = self._entries.get(key)
+        if link is not None:
+            self._unlink(link)
+
+    def clear(self):
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self),
+                'max_size': self.max_size}
+
+
+class BloomFilter(object):
+    """A fixed size set of strings, which may report false positives.
+
+    Sized for ``capacity`` members at a false positive rate of
+    ``error_rate``; membership tests never give false negatives. Bit
+    positions are derived from the SHA-1 digest of each member by double
+    hashing, so that filters serialized with :meth:`to_bytes` can be
+    checked by any client implementing the same scheme.
+
+    """
+
+    HEADER = struct.Struct('!III')
+
+    def __init__(self, capacity, error_rate=0.001, num_bits=None,
+                 num_hashes=None, bits=None):
+        if num_bits is None:
+            capacity = max(capacity, 1)
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                     math.log(2) ** 2))
+            num_bits = (num_bits + 7) // 8 * 8
+            num_hashes = max(1, int(round(num_bits * math.log(2) /
+                                          capacity)))
+        self.capacity = capacity
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray(num_bits // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.sha1(key).digest()
+        h1, h2 = struct.unpack('!II', digest[:8])
+        return [(h1 + i * h2) % self.num_bits
+                for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        """Adds a member, counting it only if it was not already present."""
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position % 8)
+            if not self.bits[position // 8] & mask:
+                self.bits[position // 8] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(key))
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def to_bytes(self):
+        """Serializes the filter as its bit and hash counts, then bits."""
+        return (self.HEADER.pack(self.num_bits, self.num_hashes, self.count) +
+                str(self.bits))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Loads a filter serialized by :meth:`to_bytes`.
+
+        :raises: ValueError if the data is not a serialized filter
+
+        """
+        try:
+            num_bits, num_hashes, count = cls.HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('Truncated bloom filter')
+        bits = bytearray(data[cls.HEADER.size:])
+        if not num_hashes or not num_bits or len(bits) * 8 != num_bits:
+            raise ValueError('Invalid bloom filter')
+        bloom = cls(count, num_bits=num_bits, num_hashes=num_hashes,
+                    bits=bits)
+        bloom.count = count
+        return bloom
+
+
 def hash_signed_token(signed_text):
     hash_ = hashlib.md5()
     hash_.update(signed_text)
@@ -0,0 +1,269 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pools of long-lived python worker processes fed over pipes.
+
+Keystone writes batches of JSON encoded requests to a worker's stdin, one
+batch per line, and the worker answers each batch with one line of
+``[ok, result]`` pairs, which :func:`serve` takes care of. Pipes are waited
+on by eventlet without blocking the hub, so CPU bound work handed to the
+workers neither stalls keystone nor requires it to fork per request.
+
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import Queue
+
+from keystone.common import logging
+from keystone import config
+
+
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+
+config.register_str('worker_python', default=None)
+
+
+def _python():
+    """Returns the python interpreter which runs the workers.
+
+    Under mod_wsgi, sys.executable is the web server rather than python, so
+    the interpreter of the installation keystone runs from is used instead,
+    unless ``worker_python`` names one.
+
+    """
+    if CONF.worker_python:
+        return CONF.worker_python
+    if 'mod_wsgi' in sys.modules:
+        return os.path.join(sys.exec_prefix, 'bin', 'python')
+    return sys.executable
+
+
+def _subprocess():
+    """Returns the subprocess module whose pipes the pool threads can use."""
+    try:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            from eventlet.green import subprocess
+            return subprocess
+    except ImportError:
+        pass
+    import subprocess
+    return subprocess
+
+
+class WorkerError(Exception):
+    """A job failed, or got no answer from the workers in time."""
+
+
+class _Job(object):
+    def __init__(self, request):
+        self.request = request
+        self.queued_at = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # the worker process the job was sent to, if any
+        self.process = None
+        self.cancelled = False
+
+
+class WorkerPool(object):
+    """Hands jobs to a pool of worker processes running ``module.function``.
+
+    Each of the ``size`` threads of the pool owns a worker process, which is
+    (re)spawned whenever it is found dead. Jobs queued while a worker is busy
+    are sent to it together, up to ``batch_size`` of them, on its next round
+    trip. A job which gets no answer within ``timeout`` seconds fails, and
+    the worker it was sent to is killed, failing the rest of its batch, so
+    that a hung worker is replaced rather than holding its thread forever.
+
+    """
+
+    def __init__(self, module, function, size, batch_size=1, timeout=60):
+        self.module = module
+        self.function = function
+        self.size = size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = 0
+        self._batches = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._run_worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _spawn(self):
+        pipes = _subprocess()
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p])
+        return pipes.Popen([_python(), '-c',
+                            'import %s as worker; worker.%s()' % (
+                                self.module, self.function)],
+                           stdin=pipes.PIPE,
+                           stdout=pipes.PIPE,
+                           env=env)
+
+    def _next_batch(self):
+        """Returns the next jobs to send, or None once the pool is closed."""
+        job = self._queue.get()
+        if job is None:
+            return None
+        jobs = [job]
+        while len(jobs) < self.batch_size:
+            try:
+                job = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is None:
+                # leave the shutdown to the next round trip
+                self._queue.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _run_worker(self):
+        process = None
+        while True:
+            jobs = self._next_batch()
+            if jobs is None:
+                break
+            try:
+                if process is None or process.poll() is not None:
+                    process = self._spawn()
+                with self._lock:
+                    jobs = [job for job in jobs if not job.cancelled]
+                    for job in jobs:
+                        job.process = process
+                if not jobs:
+                    continue
+                process.stdin.write(json.dumps([job.request for job in jobs]))
+                process.stdin.write('\n')
+                process.stdin.flush()
+                results = json.loads(process.stdout.readline())
+            except Exception, e:
+                LOG.error('%s worker failed: %s' % (self.module, e))
+                if process is not None:
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+                process = None
+                results = [[False, str(e)]] * len(jobs)
+
+            finished_at = time.time()
+            with self._lock:
+                self._batches += 1
+                for job in jobs:
+                    latency = finished_at - job.queued_at
+                    self._jobs += 1
+                    self._latency += latency
+                    self._max_latency = max(self._max_latency, latency)
+            for job, (ok, result) in zip(jobs, results):
+                if ok:
+                    job.result = result
+                else:
+                    job.error = result
+                job.done.set()
+        if process is not None:
+            process.stdin.close()
+            process.wait()
+
+    def submit(self, request):
+        """Runs a job on a worker and returns its result.
+
+        :raises: WorkerError if the job failed or timed out
+
+        """
+        job = _Job(request)
+        self._queue.put(job)
+        # Event.wait only returns the flag from python 2.7 on
+        job.done.wait(self.timeout)
+        if not job.done.is_set():
+            with self._lock:
+                job.cancelled = True
+                process = job.process
+            if process is not None:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+            raise WorkerError('no answer from the %s workers' % self.module)
+        if job.error is not None:
+            raise WorkerError(job.error)
+        return job.result
+
+    def stats(self):
+        with self._lock:
+            return {'queue_depth': self._queue.qsize(),
+                    'jobs': self._jobs,
+                    'batches': self._batches,
+                    'avg_latency': self._latency / (self._jobs or 1),
+                    'max_latency': self._max_latency}
+
+    def close(self):
+        """Stops the threads and processes once the queue is drained."""
+        for i in range(self.size):
+            self._queue.put(None)
+
+
+def serve(handler, parallel=False):
+    """Answers the batches of a WorkerPool on stdin, until stdin is closed.
+
+    :param handler: function called with each request, whose return value is
+                    sent back; the error it raises is sent back instead (or,
+                    for a failed command, the command's output)
+    :param parallel: run the requests of a batch in parallel threads
+
+    """
+    # errors are sent back to keystone, which logs them
+    logging.root.setLevel(logging.CRITICAL)
+
+    def run(request, results, i):
+        try:
+            results[i] = [True, handler(request)]
+        except Exception, e:
+            results[i] = [False, str(getattr(e, 'output', None) or e)]
+
+    for line in iter(sys.stdin.readline, ''):
+        requests = json.loads(line)
+        results = [None] * len(requests)
+        if parallel:
+            threads = [threading.Thread(target=run, args=(request, results, i))
+                       for i, request in enumerate(requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for i, request in enumerate(requests):
+                run(request, results, i)
+        sys.stdout.write(json.dumps(results))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
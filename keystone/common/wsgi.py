@@ -28,12 +28,17 @@ import ssl
 import webob.dec
 import webob.exc
 
+from keystone.common import cms
 from keystone.common import logging
 from keystone.common import utils
+from keystone import config
 from keystone import exception
 from keystone.openstack.common import jsonutils
 
 
+CONF = config.CONF
+config.register_int('admin_cache_size', group='policy', default=0)
+
 LOG = logging.getLogger(__name__)
 
 # Environment variable used to pass the request context
@@ -44,6 +49,25 @@ CONTEXT_ENV = 'openstack.context'
 PARAMS_ENV = 'openstack.params'
 
 
+_ADMIN_CACHE = None
+
+
+def admin_cache():
+    """Returns the cache of tokens allowed admin access, or None if disabled.
+
+    The cache is shared by every Application in the process, and is rebuilt
+    whenever ``[policy] admin_cache_size`` changes.
+
+    """
+    global _ADMIN_CACHE
+    if CONF.policy.admin_cache_size <= 0:
+        _ADMIN_CACHE = None
+    elif (_ADMIN_CACHE is None or
+            _ADMIN_CACHE.max_size != CONF.policy.admin_cache_size):
+        _ADMIN_CACHE = utils.LRUCache(CONF.policy.admin_cache_size)
+    return _ADMIN_CACHE
+
+
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
 
@@ -198,6 +222,7 @@ class Application(BaseApplication):
         # allow middleware up the stack to provide context & params
         context = req.environ.get(CONTEXT_ENV, {})
         context['query_string'] = dict(req.params.iteritems())
+        context['headers'] = dict(req.headers.iteritems())
         params = req.environ.get(PARAMS_ENV, {})
         if 'REMOTE_USER' in req.environ:
             context['REMOTE_USER'] = req.environ['REMOTE_USER']
@@ -242,7 +267,22 @@ class Application(BaseApplication):
                      for (k, v) in d.iteritems()])
 
     def assert_admin(self, context):
+        """Checks that the request is allowed admin access.
+
+        With ``[policy] admin_cache_size`` set, tokens passing the check are
+        remembered until they expire or the token backend reports a new
+        revocation generation, so that a burst of admin calls with the same
+        token only looks up the token and enforces the policy once.
+
+        """
         if not context['is_admin']:
+            cache = admin_cache()
+            if cache is not None and context['token_id'] is not None:
+                key = cms.cms_hash_token(context['token_id'])
+                generation = self.token_api.get_revocation_generation(context)
+                if cache.get(key) == generation:
+                    return
+
             try:
                 user_token_ref = self.token_api.get_token(
                     context=context, token_id=context['token_id'])
@@ -263,12 +303,15 @@ class Application(BaseApplication):
                 logging.debug('Invalid tenant')
                 raise exception.Unauthorized()
 
-            # NOTE(vish): this is pretty inefficient
-            creds['roles'] = [self.identity_api.get_role(context, role)['name']
-                              for role in creds.get('roles', [])]
+            creds['roles'] = [role_ref['name']
+                              for role_ref in self.identity_api.get_roles(
+                                  context, creds.get('roles', []))]
             # Accept either is_admin or the admin role
             self.policy_api.enforce(context, creds, 'admin_required', {})
 
+            if cache is not None and context['token_id'] is not None:
+                cache.set(key, generation, user_token_ref.get('expires'))
+
 
 class Middleware(Application):
     """Base WSGI middleware.
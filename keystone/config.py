@@ -122,6 +122,12 @@ def register_cli_int(*args, **kw):
     group = kw.pop('group', None)
     return conf.register_cli_opt(cfg.IntOpt(*args, **kw), group=group)
 
+
+def register_float(*args, **kw):
+    conf = kw.pop('conf', CONF)
+    group = kw.pop('group', None)
+    return conf.register_opt(cfg.FloatOpt(*args, **kw), group=group)
+
 register_str('admin_token', default='ADMIN')
 register_str('bind_host', default='0.0.0.0')
 register_str('compute_port', default=8774)
@@ -149,6 +155,11 @@ register_str('ca_certs', group='signing',
 register_int('key_size', group='signing', default=1024)
 register_int('valid_days', group='signing', default=3650)
 register_str('ca_password', group='signing', default=None)
+register_int('verify_cache_size', group='signing', default=1000)
+register_str('cms_engine', group='signing', default='subprocess')
+register_int('pool_size', group='signing', default=2)
+register_int('pool_batch_size', group='signing', default=16)
+register_int('pool_timeout', group='signing', default=60)
 
 
 # sql options
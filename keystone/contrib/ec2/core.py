@@ -103,6 +103,8 @@ class Ec2Controller(wsgi.Application):
         self.token_api = token.Manager()
         self.policy_api = policy.Manager()
         self.ec2_api = Manager()
+        # renders the tokens issued for ec2 credentials
+        self.token_controller = service.TokenController()
         super(Ec2Controller, self).__init__()
 
     def check_signature(self, creds_ref, credentials):
@@ -155,9 +157,7 @@ class Ec2Controller(wsgi.Application):
                                           credentials['access'])
         self.check_signature(creds_ref, credentials)
 
-        # TODO(termie): don't create new tokens every time
         # TODO(termie): this is copied from TokenController.authenticate
-        token_id = uuid.uuid4().hex
         tenant_ref = self.identity_api.get_tenant(
             context=context,
             tenant_id=creds_ref['tenant_id'])
@@ -175,8 +175,7 @@ class Ec2Controller(wsgi.Application):
         roles = metadata_ref.get('roles', [])
         if not roles:
             raise exception.Unauthorized(message='User not valid for tenant.')
-        roles_ref = [self.identity_api.get_role(context, role_id)
-                     for role_id in roles]
+        roles_ref = self.identity_api.get_roles(context, roles)
 
         catalog_ref = self.catalog_api.get_catalog(
             context=context,
@@ -184,17 +183,27 @@ class Ec2Controller(wsgi.Application):
             tenant_id=tenant_ref['id'],
             metadata=metadata_ref)
 
-        token_ref = self.token_api.create_token(
-            context, token_id, dict(id=token_id,
-                                    user=user_ref,
-                                    tenant=tenant_ref,
-                                    metadata=metadata_ref))
+        token_controller = self.token_controller
+        token_ref = token_controller._find_reusable_token(
+            context, user_ref, tenant_ref, metadata_ref, token_format='UUID')
+        if token_ref is not None:
+            token_ref['id'] = token_ref['key']
+        else:
+            token_id = uuid.uuid4().hex
+            service_catalog = token_controller._format_catalog(catalog_ref)
+            token_ref = self.token_api.create_token(
+                context, token_id, dict(key=token_id,
+                                        id=token_id,
+                                        user=user_ref,
+                                        tenant=tenant_ref,
+                                        metadata=metadata_ref,
+                                        roles=roles_ref,
+                                        catalog=service_catalog))
 
         # TODO(termie): make this a util function or something
         # TODO(termie): i don't think the ec2 middleware currently expects a
         #               full return, but it contains a note saying that it
         #               would be better to expect a full return
-        token_controller = service.TokenController()
         return token_controller._format_authenticate(
             token_ref, roles_ref, catalog_ref)
 
@@ -19,6 +19,7 @@ from keystone import exception
 from keystone import identity
 from keystone import policy
 from keystone import token
+from keystone.common import cms
 from keystone.common import logging
 from keystone.common import manager
 from keystone.common import wsgi
@@ -96,6 +97,16 @@ class StatsController(wsgi.Application):
                     'api': 'public',
                     'extra': self.stats_api.get_stats(context, 'public'),
                 },
+                {
+                    'type': 'token_cache',
+                    'api': 'admin',
+                    'extra': self.token_api.get_cache_stats(context),
+                },
+                {
+                    'type': 'cms_engine',
+                    'api': 'admin',
+                    'extra': cms.get_engine().stats(),
+                },
             ]
         }
 
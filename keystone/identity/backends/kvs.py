@@ -39,7 +39,8 @@ class Identity(kvs.Base, identity.Driver):
         except exception.UserNotFound:
             raise AssertionError('Invalid user / password')
 
-        if not utils.check_password(password, user_ref.get('password')):
+        if not identity.check_password(user_id, password,
+                                       user_ref.get('password')):
             raise AssertionError('Invalid user / password')
 
         if tenant_id is not None:
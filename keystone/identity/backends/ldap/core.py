@@ -144,6 +144,14 @@ class Identity(identity.Driver):
         except exception.NotFound:
             raise exception.RoleNotFound(role_id=role_id)
 
+    def get_roles(self, role_ids):
+        role_refs = dict((role_ref['id'], role_ref)
+                         for role_ref in self.role.get_list(role_ids))
+        try:
+            return [role_refs[role_id] for role_id in role_ids]
+        except KeyError as e:
+            raise exception.RoleNotFound(role_id=e.args[0])
+
     def list_roles(self):
         return self.role.get_all()
 
@@ -691,6 +699,18 @@ class RoleApi(common_ldap.BaseLdap, ApiShimMixin):
         except IndexError:
             raise exception.RoleNotFound(role_id=name)
 
+    def get_list(self, role_ids):
+        """Returns the roles with any of the given ids, in one search."""
+        query = None
+        # nested pairs of (|...) are used, as fakeldap only supports those
+        for role_id in set(role_ids):
+            term = '(%s=%s)' % (self.id_attr,
+                                ldap_filter.escape_filter_chars(role_id))
+            query = term if query is None else '(|%s%s)' % (term, query)
+        if query is None:
+            return []
+        return self.get_all(query)
+
     def add_user(self, role_id, user_id, tenant_id=None):
         role_dn = self._subrole_id_to_dn(role_id, tenant_id)
         conn = self.get_connection()
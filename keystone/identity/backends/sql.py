@@ -103,7 +103,8 @@ class Identity(sql.Base, identity.Driver):
         https://blueprints.launchpad.net/keystone/+spec/sql-identiy-pam
 
         """
-        return utils.check_password(password, user_ref.get('password'))
+        return identity.check_password(user_ref['id'], password,
+                                       user_ref.get('password'))
 
     # Identity interface
     def authenticate(self, user_id=None, tenant_id=None, password=None):
@@ -140,6 +141,64 @@ class Identity(sql.Base, identity.Driver):
 
         return (identity.filter_user(user_ref), tenant_ref, metadata_ref)
 
+    def get_auth_bundle(self, password, user_id=None, user_name=None,
+                        tenant_id=None, tenant_name=None):
+        return self._get_bundle(user_id, user_name, tenant_id, tenant_name,
+                                check=True, password=password)
+
+    def get_user_bundle(self, user_id=None, user_name=None, tenant_id=None,
+                        tenant_name=None):
+        return self._get_bundle(user_id, user_name, tenant_id, tenant_name,
+                                check=False)
+
+    def _get_bundle(self, user_id, user_name, tenant_id, tenant_name, check,
+                    password=None):
+        """Fetches the user, tenant, membership and metadata in one query."""
+        session = self.get_session()
+        if tenant_name is not None:
+            tenant_filter = Tenant.name == tenant_name
+        elif tenant_id is not None:
+            tenant_filter = Tenant.id == tenant_id
+        else:
+            tenant_filter = None
+
+        if tenant_filter is None:
+            query = session.query(User)
+        else:
+            query = session.query(User, Tenant,
+                                  UserTenantMembership.tenant_id, Metadata)
+            query = query.outerjoin(Tenant, tenant_filter)
+            query = query.outerjoin(UserTenantMembership, sql.and_(
+                UserTenantMembership.user_id == User.id,
+                UserTenantMembership.tenant_id == Tenant.id))
+            query = query.outerjoin(Metadata, sql.and_(
+                Metadata.user_id == User.id,
+                Metadata.tenant_id == Tenant.id))
+        if user_name is not None:
+            query = query.filter(User.name == user_name)
+        else:
+            query = query.filter(User.id == user_id)
+        row = query.first()
+        if row is None:
+            raise exception.UserNotFound(user_id=user_name or user_id)
+
+        if tenant_filter is None:
+            user_ref, tenant_ref, member, metadata_ref = row, None, None, {}
+        else:
+            user_ref, tenant_ref, member, metadata_ref = row
+        user_ref = user_ref.to_dict()
+        if check and not self._check_password(password, user_ref):
+            raise AssertionError('Invalid user / password')
+        if tenant_filter is not None:
+            if tenant_ref is None:
+                raise exception.TenantNotFound(
+                    tenant_id=tenant_name or tenant_id)
+            if member is None:
+                raise AssertionError('Invalid tenant')
+            tenant_ref = tenant_ref.to_dict()
+            metadata_ref = metadata_ref.data if metadata_ref else {}
+        return identity.filter_user(user_ref), tenant_ref, metadata_ref
+
     def get_tenant(self, tenant_id):
         session = self.get_session()
         tenant_ref = session.query(Tenant).filter_by(id=tenant_id).first()
@@ -201,6 +260,17 @@ class Identity(sql.Base, identity.Driver):
             raise exception.RoleNotFound(role_id=role_id)
         return role_ref
 
+    def get_roles(self, role_ids):
+        if not role_ids:
+            return []
+        session = self.get_session()
+        query = session.query(Role).filter(Role.id.in_(set(role_ids)))
+        role_refs = dict((role_ref.id, role_ref) for role_ref in query)
+        try:
+            return [role_refs[role_id] for role_id in role_ids]
+        except KeyError as e:
+            raise exception.RoleNotFound(role_id=e.args[0])
+
     def list_users(self):
         session = self.get_session()
         user_refs = session.query(User)
@@ -16,6 +16,10 @@
 
 """Main entry point into the Identity service."""
 
+import datetime
+import hashlib
+import hmac
+import os
 import urllib
 import urlparse
 import uuid
@@ -23,18 +27,87 @@ import uuid
 from keystone.common import controller
 from keystone.common import logging
 from keystone.common import manager
+from keystone.common import utils
 from keystone.common import wsgi
 from keystone import config
 from keystone import exception
+from keystone.openstack.common import timeutils
 from keystone import policy
 from keystone import token
 
 
 CONF = config.CONF
+config.register_int('role_cache_time', group='identity', default=0)
+config.register_int('password_cache_time', group='identity', default=0)
+config.register_int('password_cache_size', group='identity', default=1000)
 
 LOG = logging.getLogger(__name__)
 
 
+# (load time, dict of role_ref by role id)
+_ROLES = None
+
+# user id -> (password HMAC, stored hash HMAC) of recently verified passwords
+_PASSWORDS = None
+_PASSWORD_KEY = os.urandom(32)
+
+
+def password_cache():
+    """Returns the process-wide verified password cache, or None if disabled.
+
+    The cache is rebuilt whenever ``[identity] password_cache_size`` changes.
+
+    """
+    global _PASSWORDS
+    if (CONF.identity.password_cache_time <= 0 or
+            CONF.identity.password_cache_size <= 0):
+        _PASSWORDS = None
+    elif (_PASSWORDS is None or
+            _PASSWORDS.max_size != CONF.identity.password_cache_size):
+        _PASSWORDS = utils.LRUCache(CONF.identity.password_cache_size)
+    return _PASSWORDS
+
+
+def _password_hmac(value):
+    value_utf8 = utils.trunc_password(value).encode('utf-8')
+    return hmac.new(_PASSWORD_KEY, value_utf8, hashlib.sha256).hexdigest()
+
+
+def check_password(user_id, password, hashed):
+    """Check a user's password against its stored hash.
+
+    Successful checks are remembered for ``[identity] password_cache_time``
+    seconds, so that a user repeating the same password against the same
+    stored hash skips the crypt call. Only HMACs, keyed with a random key
+    private to this process, are kept.
+
+    """
+    cache = password_cache()
+    if cache is None or password is None or hashed is None:
+        return utils.check_password(password, hashed)
+
+    verified = (_password_hmac(password), _password_hmac(hashed))
+    cached = cache.get(user_id)
+    if (cached is not None and
+            utils.auth_str_equal(verified[0], cached[0]) and
+            utils.auth_str_equal(verified[1], cached[1])):
+        return True
+
+    if not utils.check_password(password, hashed):
+        return False
+    expires = timeutils.utcnow() + datetime.timedelta(
+        seconds=CONF.identity.password_cache_time)
+    cache.set(user_id, verified, expires)
+    return True
+
+
+def invalidate_password(user_id):
+    """Forget any verified password of the user."""
+    cache = password_cache()
+    if cache is not None:
+        cache.delete(user_id)
+
+
 def filter_user(user_ref):
     """Filter out private items in a user dict ('password' and 'tenants')
 
@@ -64,6 +137,77 @@ class Manager(manager.Manager):
     def __init__(self):
         super(Manager, self).__init__(CONF.identity.driver)
 
+    def _get_all_roles(self):
+        """Returns every role by id, from the process-wide role cache.
+
+        The cache is shared by every Manager in the process. It is reloaded
+        after ``[identity] role_cache_time`` seconds, which bounds how long
+        role changes made by other processes go unnoticed.
+
+        """
+        global _ROLES
+        now = timeutils.utcnow()
+        max_age = datetime.timedelta(seconds=CONF.identity.role_cache_time)
+        if _ROLES is None or now - _ROLES[0] > max_age:
+            roles = dict((role_ref['id'],
+                          dict((k, role_ref[k]) for k in role_ref))
+                         for role_ref in self.driver.list_roles())
+            _ROLES = (now, roles)
+        return _ROLES[1]
+
+    def _invalidate_roles(self):
+        global _ROLES
+        _ROLES = None
+
+    def get_role(self, context, role_id):
+        """Get a role by id, through the role cache if it is enabled."""
+        if CONF.identity.role_cache_time <= 0:
+            return self.driver.get_role(role_id)
+        role_ref = self._get_all_roles().get(role_id)
+        if role_ref is None:
+            # missing, or created since the cache was loaded
+            role_ref = self.driver.get_role(role_id)
+            self._invalidate_roles()
+            return role_ref
+        return role_ref.copy()
+
+    def get_roles(self, context, role_ids):
+        """Get many roles by id, through the role cache if it is enabled."""
+        if CONF.identity.role_cache_time <= 0:
+            return self.driver.get_roles(role_ids)
+        return [self.get_role(context, role_id) for role_id in role_ids]
+
+    def update_user(self, context, user_id, user):
+        try:
+            return self.driver.update_user(user_id, user)
+        finally:
+            if 'password' in user:
+                invalidate_password(user_id)
+
+    def delete_user(self, context, user_id):
+        try:
+            return self.driver.delete_user(user_id)
+        finally:
+            invalidate_password(user_id)
+
+    def create_role(self, context, role_id, role):
+        try:
+            return self.driver.create_role(role_id, role)
+        finally:
+            self._invalidate_roles()
+
+    def update_role(self, context, role_id, role):
+        try:
+            return self.driver.update_role(role_id, role)
+        finally:
+            self._invalidate_roles()
+
+    def delete_role(self, context, role_id):
+        try:
+            return self.driver.delete_role(role_id)
+        finally:
+            self._invalidate_roles()
+
 
 class Driver(object):
     """Interface description for an Identity driver."""
@@ -77,6 +221,61 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
+    def get_auth_bundle(self, password, user_id=None, user_name=None,
+                        tenant_id=None, tenant_name=None):
+        """Get everything needed to issue a token to a user.
+
+        The user is given by id or name and its password is checked like
+        :meth:`authenticate` does; a missing password never matches. When a
+        tenant is requested by id or name, the user must be a member of it.
+
+        Backends able to fetch all of it in one round trip should override
+        this; by default it is assembled from the individual lookups.
+
+        :returns: (user_ref, tenant_ref, metadata_ref), with tenant_ref None
+                  and metadata_ref empty if no tenant was requested
+        :raises: AssertionError if the password is wrong or the user is not
+                 a member of the tenant,
+                 keystone.exception.UserNotFound,
+                 keystone.exception.TenantNotFound
+
+        """
+        if user_name is not None:
+            user_id = self.get_user_by_name(user_name)['id']
+        user_ref = self.authenticate(user_id=user_id, password=password)[0]
+        return (user_ref,) + self._get_tenant_bundle(
+            user_id, tenant_id, tenant_name)
+
+    def get_user_bundle(self, user_id=None, user_name=None, tenant_id=None,
+                        tenant_name=None):
+        """Get everything needed to issue a token to an authenticated user.
+
+        Like :meth:`get_auth_bundle`, for a user already authenticated by
+        other means (a token, or the web server), so no password is checked.
+
+        """
+        if user_name is not None:
+            user_id = self.get_user_by_name(user_name)['id']
+        user_ref = self.get_user(user_id)
+        return (user_ref,) + self._get_tenant_bundle(
+            user_id, tenant_id, tenant_name)
+
+    def _get_tenant_bundle(self, user_id, tenant_id, tenant_name):
+        tenant_ref = None
+        metadata_ref = {}
+        if tenant_name is not None:
+            tenant_ref = self.get_tenant_by_name(tenant_name)
+        elif tenant_id is not None:
+            tenant_ref = self.get_tenant(tenant_id)
+        if tenant_ref is not None:
+            if tenant_ref['id'] not in self.get_tenants_for_user(user_id):
+                raise AssertionError('Invalid tenant')
+            try:
+                metadata_ref = self.get_metadata(user_id, tenant_ref['id'])
+            except exception.MetadataNotFound:
+                pass
+        return tenant_ref, metadata_ref
+
     def get_tenant(self, tenant_id):
         """Get a tenant by id.
 
@@ -421,6 +620,18 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
+    def get_roles(self, role_ids):
+        """Get many roles by ID.
+
+        Backends able to look up several roles in one round trip should
+        override this; by default the roles are fetched one at a time.
+
+        :returns: list of role_refs, in the order of role_ids
+        :raises: keystone.exception.RoleNotFound
+
+        """
+        return [self.get_role(role_id) for role_id in role_ids]
+
     def update_role(self, role_id, role):
         """Updates an existing role.
 
@@ -661,8 +872,7 @@ class UserController(wsgi.Application):
         # If the password was changed or the user was disabled we clear tokens
         if user.get('password') or not user.get('enabled', True):
             try:
-                for token_id in self.token_api.list_tokens(context, user_id):
-                    self.token_api.delete_token(context, token_id)
+                self.token_api.revoke_tokens(context, user_id)
             except exception.NotImplemented:
                 # The users status has been changed but tokens remain valid for
                 # backends that can't list tokens for users
@@ -711,8 +921,7 @@ class RoleController(wsgi.Application):
 
         roles = self.identity_api.get_roles_for_user_and_tenant(
             context, user_id, tenant_id)
-        return {'roles': [self.identity_api.get_role(context, x)
-                          for x in roles]}
+        return {'roles': self.identity_api.get_roles(context, roles)}
 
     # CRUD extension
     def get_role(self, context, role_id):
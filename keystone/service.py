@@ -14,6 +14,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import copy
+import datetime
+import hashlib
+import subprocess
 import uuid
 import routes
 import json
@@ -22,6 +27,7 @@ from keystone import config
 from keystone import catalog
 from keystone.common import cms
 from keystone.common import logging
+from keystone.common import utils
 from keystone.common import wsgi
 from keystone import exception
 from keystone import identity
@@ -222,6 +228,14 @@ class AdminRouter(wsgi.ComposingRouter):
                        controller=auth_controller,
                        action='revocation_list',
                        conditions=dict(method=['GET']))
+        mapper.connect('/tokens/revoked/filter',
+                       controller=auth_controller,
+                       action='revocation_filter',
+                       conditions=dict(method=['GET']))
+        mapper.connect('/tokens/validate',
+                       controller=auth_controller,
+                       action='validate_tokens',
+                       conditions=dict(method=['POST']))
         mapper.connect('/tokens/{token_id}',
                        controller=auth_controller,
                        action='validate_token',
@@ -424,6 +438,19 @@ class TokenController(wsgi.Application):
         self.identity_api = identity.Manager()
         self.token_api = token.Manager()
         self.policy_api = policy.Manager()
+        # (revocation generation, etag, signed revocation list)
+        self._revocation_list = None
+        # (etag, signed revocation list) by (revocation generation, since)
+        self._revocation_deltas = utils.LRUCache(64)
+        # (revocation generation, etag, signed revocation filter)
+        self._revocation_filter = None
+        # verified PKI tokens, by token hash
+        self._verified_tokens = utils.LRUCache(
+            config.CONF.signing.verify_cache_size)
+        cms.set_engine(config.CONF.signing.cms_engine,
+                       pool_size=config.CONF.signing.pool_size,
+                       batch_size=config.CONF.signing.pool_batch_size,
+                       timeout=config.CONF.signing.pool_timeout)
         super(TokenController, self).__init__()
 
     def ca_cert(self, context, auth=None):
@@ -492,6 +519,17 @@ class TokenController(wsgi.Application):
             LOG.warning('Tenant %s is disabled' % tenant_ref["id"])
             raise exception.Unauthorized()
 
+        token_ref = self._find_reusable_token(context, user_ref, tenant_ref,
+                                              metadata_ref,
+                                              auth_token_data['expires'])
+        if token_ref is not None:
+            token_data = self._format_token(
+                token_ref, [dict(name=role_ref['name'])
+                            for role_ref in token_ref['roles']])
+            token_data['access']['serviceCatalog'] = token_ref['catalog']
+            token_data['access']['token']['id'] = token_ref['key']
+            return token_data
+
         if tenant_ref:
             catalog_ref = self.catalog_api.get_catalog(
                 context=context,
@@ -503,10 +541,9 @@ class TokenController(wsgi.Application):
 
         auth_token_data['id'] = 'placeholder'
 
-        roles_ref = []
-        for role_id in metadata_ref.get('roles', []):
-            role_ref = self.identity_api.get_role(context, role_id)
-            roles_ref.append(dict(name=role_ref['name']))
+        role_refs = self.identity_api.get_roles(
+            context, metadata_ref.get('roles', []))
+        roles_ref = [dict(name=role_ref['name']) for role_ref in role_refs]
 
         token_data = self._format_token(auth_token_data, roles_ref)
 
@@ -519,10 +556,14 @@ class TokenController(wsgi.Application):
             token_id = cms.cms_sign_token(json.dumps(token_data),
                                           config.CONF.signing.certfile,
                                           config.CONF.signing.keyfile)
+        elif config.CONF.signing.token_format == 'PKIZ':
+            token_id = cms.pkiz_sign(json.dumps(token_data),
+                                     config.CONF.signing.certfile,
+                                     config.CONF.signing.keyfile)
         else:
             raise exception.UnexpectedError(
                 'Invalid value for token_format: %s.'
-                '  Allowed values are PKI or UUID.' %
+                '  Allowed values are PKI, PKIZ or UUID.' %
                 config.CONF.signing.token_format)
         try:
             self.token_api.create_token(
@@ -530,7 +571,9 @@ class TokenController(wsgi.Application):
                                         id=token_id,
                                         user=user_ref,
                                         tenant=tenant_ref,
-                                        metadata=metadata_ref))
+                                        metadata=metadata_ref,
+                                        roles=role_refs,
+                                        catalog=service_catalog))
         except Exception as e:
             # an identical token may have been created already.
             # if so, return the token_data as it is also identical
@@ -544,6 +587,61 @@ class TokenController(wsgi.Application):
 
         return token_data
 
+    def _find_reusable_token(self, context, user_ref, tenant_ref,
+                             metadata_ref, expires=None, token_format=None):
+        """Returns a stored token identical to the one about to be issued.
+
+        Only used with ``[token] reuse`` set, to save signing and storing a
+        new token for every authentication with the same credentials. The
+        token must be in ``token_format`` (by default the configured token
+        format), have been issued to the same user and tenant ids with the
+        same metadata, and expire no later than ``expires`` but at least
+        ``[token] reuse_min_lifetime`` seconds from now.
+
+        :returns: token_ref, with the token id given to the client as
+                  ``key``, or None
+
+        """
+        if not config.CONF.token.reuse:
+            return None
+        token_format = token_format or config.CONF.signing.token_format
+        tenant_id = tenant_ref['id'] if tenant_ref else None
+        token_ids = self.token_api.list_tokens(context, user_ref['id'],
+                                               tenant_id)
+        if not token_ids:
+            return None
+
+        min_expires = timeutils.utcnow() + datetime.timedelta(
+            seconds=config.CONF.token.reuse_min_lifetime)
+        reusable = None
+        for token_ref in self.token_api.get_tokens(context,
+                                                   token_ids).itervalues():
+            if ('key' not in token_ref or 'roles' not in token_ref or
+                    'catalog' not in token_ref):
+                continue
+            if self._get_token_format(token_ref['key']) != token_format:
+                continue
+            if (token_ref['expires'] is None or
+                    token_ref['expires'] <= min_expires or
+                    (expires is not None and token_ref['expires'] > expires)):
+                continue
+            # the stored user and tenant are as rendered into the token, which
+            # may differ from the identity backend's in other attributes
+            if (token_ref['user']['id'] != user_ref['id'] or
+                    (token_ref.get('tenant') or {}).get('id') != tenant_id or
+                    token_ref['metadata'] != metadata_ref):
+                continue
+            if reusable is None or token_ref['expires'] > reusable['expires']:
+                reusable = token_ref
+        return reusable
+
+    def _get_token_format(self, token_id):
+        if cms.is_pkiz_token(token_id):
+            return 'PKIZ'
+        if cms.is_ans1_token(token_id):
+            return 'PKI'
+        return 'UUID'
+
     def _authenticate_token(self, context, auth):
         """Try to authenticate using an already existing token.
 
@@ -566,24 +664,16 @@ class TokenController(wsgi.Application):
             LOG.warning("Token not found: " + str(old_token))
             raise exception.Unauthorized()
 
-        user_ref = old_token_ref['user']
-        user_id = user_ref['id']
-
-        current_user_ref = self.identity_api.get_user(context=context,
-                                                      user_id=user_id)
-
-        tenant_id = self._get_tenant_id_from_auth(context, auth)
-
-        tenant_ref = self._get_tenant_ref(context, user_id, tenant_id)
-        metadata_ref = self._get_metadata_ref(context, user_id, tenant_id)
+        user_ref, tenant_ref, metadata_ref = self._get_user_bundle(
+            context, auth, user_id=old_token_ref['user']['id'])
 
         expiry = old_token_ref['expires']
-        auth_token_data = self._get_auth_token_data(current_user_ref,
+        auth_token_data = self._get_auth_token_data(user_ref,
                                                     tenant_ref,
                                                     metadata_ref,
                                                     expiry)
 
-        return auth_token_data, (current_user_ref, tenant_ref, metadata_ref)
+        return auth_token_data, (user_ref, tenant_ref, metadata_ref)
 
     def _authenticate_local(self, context, auth):
         """Try to authenticate against the identity backend.
@@ -599,6 +689,9 @@ class TokenController(wsgi.Application):
                 attribute='password', target='passwordCredentials')
 
         password = auth['passwordCredentials']['password']
+        if not isinstance(password, basestring):
+            raise exception.ValidationError(
+                attribute='password', target='passwordCredentials')
 
         if ("userId" not in auth['passwordCredentials'] and
                 "username" not in auth['passwordCredentials']):
@@ -609,26 +702,9 @@ class TokenController(wsgi.Application):
         user_id = auth['passwordCredentials'].get('userId', None)
         username = auth['passwordCredentials'].get('username', '')
 
-        if username:
-            try:
-                user_ref = self.identity_api.get_user_by_name(
-                    context=context, user_name=username)
-                user_id = user_ref['id']
-            except exception.UserNotFound:
-                LOG.warn("User not found: %s" % user_id)
-                raise exception.Unauthorized()
-
-        tenant_id = self._get_tenant_id_from_auth(context, auth)
-
-        try:
-            auth_info = self.identity_api.authenticate(
-                context=context,
-                user_id=user_id,
-                password=password,
-                tenant_id=tenant_id)
-        except AssertionError as e:
-            raise exception.Unauthorized(str(e))
-        (user_ref, tenant_ref, metadata_ref) = auth_info
+        user_ref, tenant_ref, metadata_ref = self._get_auth_bundle(
+            context, auth, password, user_id=user_id,
+            user_name=username or None)
 
         expiry = self.token_api._get_default_expire_time(context=context)
         auth_token_data = self._get_auth_token_data(user_ref,
@@ -646,19 +722,8 @@ class TokenController(wsgi.Application):
         if 'REMOTE_USER' not in context:
             raise ExternalAuthNotApplicable()
 
-        username = context['REMOTE_USER']
-        try:
-            user_ref = self.identity_api.get_user_by_name(
-                context=context, user_name=username)
-            user_id = user_ref['id']
-        except exception.UserNotFound:
-            LOG.warn("User not found: %s" % username)
-            raise exception.Unauthorized()
-
-        tenant_id = self._get_tenant_id_from_auth(context, auth)
-
-        tenant_ref = self._get_tenant_ref(context, user_id, tenant_id)
-        metadata_ref = self._get_metadata_ref(context, user_id, tenant_id)
+        user_ref, tenant_ref, metadata_ref = self._get_user_bundle(
+            context, auth, user_name=context['REMOTE_USER'])
 
         expiry = self.token_api._get_default_expire_time(context=context)
         auth_token_data = self._get_auth_token_data(user_ref,
@@ -674,52 +739,44 @@ class TokenController(wsgi.Application):
                          metadata=metadata,
                          expires=expiry))
 
-    def _get_tenant_id_from_auth(self, context, auth):
-        """Extract tenant information from auth dict.
+    def _get_auth_bundle(self, context, auth, password, user_id=None,
+                         user_name=None):
+        """Returns the user, once its password is checked, and the tenant
+        requested in auth if any.
 
-        Returns a valid tenant_id if it exists, or None if not specified.
+        Returns (user_ref, tenant_ref, metadata_ref)
         """
-        tenant_id = auth.get('tenantId', None)
-        tenant_name = auth.get('tenantName', None)
-        if tenant_name:
-            try:
-                tenant_ref = self.identity_api.get_tenant_by_name(
-                    context=context, tenant_name=tenant_name)
-                tenant_id = tenant_ref['id']
-            except exception.TenantNotFound:
-                raise exception.Unauthorized()
-        return tenant_id
-
-    def _get_tenant_ref(self, context, user_id, tenant_id):
-        """Returns the tenant_ref for the user's tenant"""
-        tenant_ref = None
-        if tenant_id:
-            tenants = self.identity_api.get_tenants_for_user(context, user_id)
-            if tenant_id not in tenants:
-                LOG.warning('User %s is unauthorized for tenant %s'
-                            % (user_id, tenant_id))
-                raise exception.Unauthorized()
+        return self._get_bundle(self.identity_api.get_auth_bundle, context,
+                                auth, user_id, user_name, password=password)
 
-            try:
-                tenant_ref = self.identity_api.get_tenant(context=context,
-                                                          tenant_id=tenant_id)
-            except exception.TenantNotFound:
-                exception.Unauthorized()
-        return tenant_ref
-
-    def _get_metadata_ref(self, context, user_id, tenant_id):
-        """Returns the metadata_ref for a user in a tenant"""
-        metadata_ref = {}
-        if tenant_id:
-            try:
-                metadata_ref = self.identity_api.get_metadata(
-                    context=context,
-                    user_id=user_id,
-                    tenant_id=tenant_id)
-            except exception.MetadataNotFound:
-                metadata_ref = {}
+    def _get_user_bundle(self, context, auth, user_id=None, user_name=None):
+        """Returns a user authenticated by other means than a password, and
+        the tenant requested in auth if any.
+
+        Returns (user_ref, tenant_ref, metadata_ref)
+        """
+        return self._get_bundle(self.identity_api.get_user_bundle, context,
+                                auth, user_id, user_name)
 
-        return metadata_ref
+    def _get_bundle(self, get_bundle, context, auth, user_id, user_name,
+                    **kwargs):
+        tenant_name = auth.get('tenantName') or None
+        tenant_id = None if tenant_name else auth.get('tenantId')
+        try:
+            return get_bundle(context=context,
+                              user_id=user_id,
+                              user_name=user_name,
+                              tenant_id=tenant_id,
+                              tenant_name=tenant_name,
+                              **kwargs)
+        except AssertionError as e:
+            raise exception.Unauthorized(str(e))
+        except exception.UserNotFound:
+            LOG.warn("User not found: %s" % (user_name or user_id))
+            raise exception.Unauthorized()
+        except exception.TenantNotFound:
+            LOG.warn("Tenant not found: %s" % (tenant_name or tenant_id))
+            raise exception.Unauthorized()
 
     def _get_token_ref(self, context, token_id, belongs_to=None):
         """Returns a token if a valid one exists.
@@ -730,20 +787,47 @@ class TokenController(wsgi.Application):
         # TODO(termie): this stuff should probably be moved to middleware
         self.assert_admin(context)
 
-        if cms.is_ans1_token(token_id):
-            data = json.loads(cms.cms_verify(cms.token_to_cms(token_id),
-                                             config.CONF.signing.certfile,
-                                             config.CONF.signing.ca_certs))
-            data['access']['token']['user'] = data['access']['user']
-            data['access']['token']['metadata'] = data['access']['metadata']
+        if cms.is_ans1_token(token_id) or cms.is_pkiz_token(token_id):
+            token_ref = self._verify_pki_token(context, token_id)
             if belongs_to:
-                assert data['access']['token']['tenant']['id'] == belongs_to
-            token_ref = data['access']['token']
+                assert token_ref['tenant']['id'] == belongs_to
         else:
             token_ref = self.token_api.get_token(context=context,
                                                  token_id=token_id)
         return token_ref
 
+    def _verify_pki_token(self, context, token_id):
+        """Returns the token_ref signed into a PKI or PKIZ token.
+
+        Verifying the signature forks openssl, so verified tokens are cached
+        by hash until they expire. Every lookup is checked against the set of
+        revoked tokens, through the revocation filter of the token manager.
+
+        """
+        token_hash = cms.cms_hash_token(token_id)
+        if self.token_api.is_revoked(context, token_hash):
+            raise exception.TokenNotFound(token_id=token_hash)
+
+        token_ref = self._verified_tokens.get(token_hash)
+        if token_ref is None:
+            if cms.is_pkiz_token(token_id):
+                try:
+                    formatted = cms.pkiz_to_cms(token_id)
+                except ValueError:
+                    raise exception.TokenNotFound(token_id=token_hash)
+            else:
+                formatted = cms.token_to_cms(token_id)
+            data = json.loads(cms.cms_verify(formatted,
+                                             config.CONF.signing.certfile,
+                                             config.CONF.signing.ca_certs))
+            token_ref = data['access']['token']
+            token_ref['user'] = data['access']['user']
+            token_ref['metadata'] = data['access']['metadata']
+            expires = timeutils.normalize_time(
+                timeutils.parse_isotime(token_ref['expires']))
+            self._verified_tokens.set(token_hash, token_ref, expires)
+        return copy.deepcopy(token_ref)
+
     # admin only
     def validate_token_head(self, context, token_id):
         """Check that a token is valid.
@@ -764,17 +848,77 @@ class TokenController(wsgi.Application):
 
         Returns metadata about the token along any associated roles.
 
+        The roles and service catalog rendered when the token was issued are
+        returned, unless ``[token] live_validation`` is set, in which case
+        they are looked up again, reflecting any role renames or catalog
+        changes made since.
+
         """
         belongs_to = context['query_string'].get('belongsTo')
         token_ref = self._get_token_ref(context, token_id, belongs_to)
+        return self._format_validated_token(context, token_ref)
+
+    # admin only
+    def validate_tokens(self, context, tokens=None):
+        """Check that many tokens are valid in a single request.
+
+        Accepts a list of token ids, optionally limited to tokens owned by the
+        ``belongsTo`` tenant, and returns a map of the ``validate_token``
+        response for each of them, or None for invalid tokens.
+
+        Tokens held by the token backend are fetched in one round trip.
+
+        """
+        self.assert_admin(context)
+        if (not isinstance(tokens, list) or
+                not all(isinstance(t, basestring) for t in tokens)):
+            raise exception.ValidationError(attribute='tokens',
+                                            target='request body')
+        belongs_to = context['query_string'].get('belongsTo')
+
+        token_refs = {}
+        backend_token_ids = []
+        for token_id in tokens:
+            if cms.is_ans1_token(token_id) or cms.is_pkiz_token(token_id):
+                try:
+                    token_refs[token_id] = self._verify_pki_token(context,
+                                                                  token_id)
+                except (exception.TokenNotFound,
+                        subprocess.CalledProcessError):
+                    # reported as an invalid token
+                    LOG.debug('Unable to verify PKI token %s'
+                              % cms.cms_hash_token(token_id))
+            else:
+                backend_token_ids.append(token_id)
+        if backend_token_ids:
+            token_refs.update(self.token_api.get_tokens(context,
+                                                        backend_token_ids))
+
+        results = {}
+        for token_id in tokens:
+            token_ref = token_refs.get(token_id)
+            if token_ref is None or (
+                    belongs_to and
+                    (token_ref.get('tenant') or {}).get('id') != belongs_to):
+                results[token_id] = None
+            else:
+                results[token_id] = self._format_validated_token(context,
+                                                                 token_ref)
+        return {'tokens': results}
+
+    def _format_validated_token(self, context, token_ref):
+        # roles and catalog are stored with tokens issued by authenticate
+        if ('roles' in token_ref and 'catalog' in token_ref and
+                not config.CONF.token.live_validation):
+            o = self._format_token(token_ref, token_ref['roles'])
+            if token_ref.get('tenant'):
+                o['access']['serviceCatalog'] = token_ref['catalog']
+            return o
 
-        # TODO(termie): optimize this call at some point and put it into the
-        #               the return for metadata
         # fill out the roles in the metadata
         metadata_ref = token_ref['metadata']
-        roles_ref = []
-        for role_id in metadata_ref.get('roles', []):
-            roles_ref.append(self.identity_api.get_role(context, role_id))
+        roles_ref = self.identity_api.get_roles(
+            context, metadata_ref.get('roles', []))
 
         # Get a service catalog if possible
         # This is needed for on-behalf-of requests
@@ -794,20 +938,117 @@ class TokenController(wsgi.Application):
         self.token_api.delete_token(context=context, token_id=token_id)
 
     def revocation_list(self, context, auth=None):
+        """Returns the signed list of revoked tokens.
+
+        If a ``since`` ISO 8601 timestamp is given, only the tokens revoked
+        at or after that time are listed. Every list carries an ``until``
+        timestamp, which clients pass as ``since`` on their next request to
+        only fetch new revocations.
+
+        Revocation times come from the clocks of the keystone processes
+        which revoked the tokens, and are only listed once committed, so a
+        revocation may show up after later ones. ``until`` is therefore
+        ``[token] revocation_list_overlap`` seconds before the latest
+        revocation listed: tokens revoked since then are listed again, and
+        clients merge each list into the ones they already have.
+
+        Signing forks openssl, so signed documents are cached until the
+        token backend reports a new revocation generation. Clients sending
+        the last ETag back in If-None-Match get a 304 with no body.
+
+        """
         self.assert_admin(context)
-        tokens = self.token_api.list_revoked_tokens(context)
+        since = context.get('query_string', {}).get('since')
+        if since is not None:
+            try:
+                since = timeutils.normalize_time(
+                    timeutils.parse_isotime(since))
+            except ValueError:
+                raise exception.ValidationError(
+                    attribute='an ISO 8601 timestamp', target='since')
+
+        generation = self.token_api.get_revocation_generation(context)
+        if since is None:
+            if (self._revocation_list is None or
+                    self._revocation_list[0] != generation):
+                etag, signed_text = self._sign_revocation_list(context)
+                self._revocation_list = (generation, etag, signed_text)
+            generation, etag, signed_text = self._revocation_list
+        else:
+            signed = self._revocation_deltas.get((generation, since))
+            if signed is None:
+                signed = self._sign_revocation_list(context, since)
+                self._revocation_deltas.set((generation, since), signed)
+            etag, signed_text = signed
+
+        return self._render_signed(context, etag, signed_text)
+
+    def _render_signed(self, context, etag, signed_text):
+        """Renders a signed document, or a 304 if the client has it."""
+        headers = [('ETag', etag),
+                   ('Cache-Control', 'private, max-age=%d' %
+                    config.CONF.token.revocation_list_max_age)]
+        if_none_match = context.get('headers', {}).get('If-None-Match')
+        if if_none_match and etag in [tag.strip()
+                                      for tag in if_none_match.split(',')]:
+            return wsgi.render_response(status=(304, 'Not Modified'),
+                                        headers=headers)
+        return wsgi.render_response(body={'signed': signed_text},
+                                    headers=headers)
+
+    def _sign_revocation_list(self, context, since=None):
+        """Returns the ETag and signed text of the current revocation list.
+
+        The ETag is computed from the unsigned document, so every keystone
+        node serving the same list returns the same ETag.
+
+        """
+        tokens = self.token_api.list_revoked_tokens(context, since=since)
 
+        overlap = datetime.timedelta(
+            seconds=config.CONF.token.revocation_list_overlap)
+        until = since
         for t in tokens:
+            revoked_at = t.pop('revoked_at', None)
+            if revoked_at is not None and (until is None or
+                                           revoked_at - overlap > until):
+                until = revoked_at - overlap
             expires = t['expires']
             if not (expires and isinstance(expires, unicode)):
                     t['expires'] = timeutils.isotime(expires)
-        data = {'revoked': tokens}
+        tokens.sort(key=lambda t: t['id'])
+        data = {'revoked': tokens,
+                'until': timeutils.isotime(until) if until else None}
         json_data = json.dumps(data)
         signed_text = cms.cms_sign_text(json_data,
                                         config.CONF.signing.certfile,
                                         config.CONF.signing.keyfile)
 
-        return {'signed': signed_text}
+        return '"%s"' % hashlib.md5(json_data).hexdigest(), signed_text
+
+    def revocation_filter(self, context, auth=None):
+        """Returns a signed bloom filter of the revoked token hashes.
+
+        The signed text is the base64 encoded serialization of a
+        :class:`keystone.common.utils.BloomFilter`, which is a small
+        fraction of the size of the full revocation list. Validators
+        hitting the filter should confirm against the revocation list.
+        Signed filters are cached and ETagged like the revocation list.
+
+        """
+        self.assert_admin(context)
+        generation, bloom = self.token_api.get_revocation_filter(context)
+        if (self._revocation_filter is None or
+                self._revocation_filter[0] != generation):
+            data = bloom.to_bytes()
+            signed_text = cms.cms_sign_text(base64.b64encode(data),
+                                            config.CONF.signing.certfile,
+                                            config.CONF.signing.keyfile)
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            self._revocation_filter = (generation, etag, signed_text)
+        generation, etag, signed_text = self._revocation_filter
+
+        return self._render_signed(context, etag, signed_text)
 
     def endpoints(self, context, token_id):
         """Return a list of endpoints available to the token."""
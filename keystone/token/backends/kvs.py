@@ -15,6 +15,7 @@
 # under the License.
 
 import copy
+import heapq
 
 from keystone.common import kvs
 from keystone import exception
@@ -23,6 +24,62 @@ from keystone import token
 
 
 class Token(kvs.Base, token.Driver):
+    """Token backend storing tokens in the (shared) in-memory kvs.
+
+    To avoid scanning the whole store, the following indexes are kept next
+    to the ``token-<id>`` entries:
+
+    * ``usertokens-<user_id>``: maps the ids of a user's tokens to the id of
+      their tenant.
+    * ``revoked-tokens``: maps the ids of revoked tokens to their revocation
+      record.
+    * ``token-expiry-heap``: a heap of ``(expires, token_id)`` used to evict
+      expired tokens and revocations incrementally.
+
+    """
+
+    def _get_index(self, key, empty):
+        """Returns an index which is then updated in place."""
+        try:
+            return self.db.get(key)
+        except exception.NotFound:
+            self.db.set(key, empty)
+            return self.db.get(key)
+
+    def _user_key(self, user_id):
+        return 'usertokens-%s' % user_id
+
+    def _remove_from_user_index(self, token_id, token_ref):
+        user_id = (token_ref.get('user') or {}).get('id')
+        if user_id is None:
+            return
+        user_key = self._user_key(user_id)
+        user_index = self.db.get(user_key, {})
+        user_index.pop(token_id, None)
+        if not user_index:
+            self.db.pop(user_key, None)
+
+    def _expire_tokens(self):
+        """Evicts every token and revocation past its expiry.
+
+        :returns: number of tokens and revocations evicted
+
+        """
+        heap = self._get_index('token-expiry-heap', [])
+        revoked_index = self._get_index('revoked-tokens', {})
+        now = timeutils.utcnow()
+        count = 0
+        while heap and heap[0][0] < now:
+            expires, token_id = heapq.heappop(heap)
+            try:
+                token_ref = self.db.get('token-%s' % token_id)
+                self.db.delete('token-%s' % token_id)
+                self._remove_from_user_index(token_id, token_ref)
+                count += 1
+            except exception.NotFound:
+                if revoked_index.pop(token_id, None) is not None:
+                    count += 1
+        return count
 
     # Public interface
     def get_token(self, token_id):
@@ -37,11 +94,21 @@ class Token(kvs.Base, token.Driver):
             raise exception.TokenNotFound(token_id=token_id)
 
     def create_token(self, token_id, data):
+        self._expire_tokens()
         token_id = self.token_to_key(token_id)
         data_copy = copy.deepcopy(data)
         if 'expires' not in data:
             data_copy['expires'] = self._get_default_expire_time()
         self.db.set('token-%s' % token_id, data_copy)
+
+        user_id = (data_copy.get('user') or {}).get('id')
+        if user_id is not None:
+            tenant_id = (data_copy.get('tenant') or {}).get('id')
+            user_index = self._get_index(self._user_key(user_id), {})
+            user_index[token_id] = tenant_id
+        if data_copy['expires'] is not None:
+            heap = self._get_index('token-expiry-heap', [])
+            heapq.heappush(heap, (data_copy['expires'], token_id))
         return copy.deepcopy(data_copy)
 
     def delete_token(self, token_id):
@@ -49,39 +116,54 @@ class Token(kvs.Base, token.Driver):
         try:
             token_ref = self.get_token(token_id)
             self.db.delete('token-%s' % token_id)
-            self.db.set('revoked-token-%s' % token_id, token_ref)
         except exception.NotFound:
             raise exception.TokenNotFound(token_id=token_id)
+        self._remove_from_user_index(token_id, token_ref)
+        # the token's entry in the expiry heap now evicts the revocation
+        revoked_index = self._get_index('revoked-tokens', {})
+        revoked_index[token_id] = {'id': token_id,
+                                   'expires': token_ref['expires'],
+                                   'revoked_at': timeutils.utcnow()}
+        self.db['revocation-generation'] = self.get_revocation_generation() + 1
+        self._expire_tokens()
 
-    def list_tokens(self, user_id, tenant_id=None):
-        tokens = []
+    def revoke_tokens(self, user_id, tenant_id=None):
+        self._expire_tokens()
+        user_key = self._user_key(user_id)
+        user_index = self.db.get(user_key, {})
+        revoked_ids = [token_id
+                       for token_id, token_tenant_id in user_index.items()
+                       if tenant_id is None or token_tenant_id == tenant_id]
+        if not revoked_ids:
+            return
+        revoked_index = self._get_index('revoked-tokens', {})
         now = timeutils.utcnow()
-        for token, ref in self.db.items():
-            if not token.startswith('token-'):
-                continue
-            user = ref.get('user')
-            if not user:
-                continue
-            if user.get('id') != user_id:
-                continue
-            if ref.get('expires') and ref.get('expires') < now:
-                continue
-            if tenant_id is not None:
-                tenant = ref.get('tenant')
-                if not tenant:
-                    continue
-                if tenant.get('id') != tenant_id:
-                    continue
-            tokens.append(token.split('-', 1)[1])
-        return tokens
-
-    def list_revoked_tokens(self):
-        tokens = []
-        for token, token_ref in self.db.items():
-            if not token.startswith('revoked-token-'):
-                continue
-            record = {}
-            record['id'] = token_ref['id']
-            record['expires'] = token_ref['expires']
-            tokens.append(record)
-        return tokens
+        for token_id in revoked_ids:
+            token_ref = self.db.get('token-%s' % token_id)
+            self.db.delete('token-%s' % token_id)
+            del user_index[token_id]
+            revoked_index[token_id] = {'id': token_id,
+                                       'expires': token_ref['expires'],
+                                       'revoked_at': now}
+        if not user_index:
+            self.db.pop(user_key, None)
+        self.db['revocation-generation'] = self.get_revocation_generation() + 1
+
+    def get_revocation_generation(self):
+        return self.db.get('revocation-generation', 0)
+
+    def list_tokens(self, user_id, tenant_id=None):
+        self._expire_tokens()
+        user_index = self.db.get(self._user_key(user_id), {})
+        return [token_id
+                for token_id, token_tenant_id in user_index.iteritems()
+                if tenant_id is None or token_tenant_id == tenant_id]
+
+    def list_revoked_tokens(self, since=None):
+        self._expire_tokens()
+        revoked_index = self.db.get('revoked-tokens', {})
+        return [record.copy() for record in revoked_index.itervalues()
+                if since is None or record['revoked_at'] >= since]
+
+    def flush_expired_tokens(self):
+        return self._expire_tokens()
@@ -16,6 +16,7 @@
 
 from __future__ import absolute_import
 import copy
+import time
 
 import memcache
 
@@ -23,15 +24,19 @@ from keystone.common import utils
 from keystone import config
 from keystone import exception
 from keystone.openstack.common import jsonutils
+from keystone.openstack.common import timeutils
 from keystone import token
 
 
 CONF = config.CONF
 config.register_str('servers', group='memcache', default='localhost:11211')
+config.register_int('max_compare_and_set_retry', group='memcache', default=16)
 
 
 class Token(token.Driver):
     revocation_key = 'revocation-list'
+    revocation_bucket_seconds = 3600
+    revocation_generation_key = 'revocation-generation'
 
     def __init__(self, client=None):
         self._memcache_client = client
@@ -42,7 +47,8 @@ class Token(token.Driver):
 
     def _get_memcache_client(self):
         memcache_servers = CONF.memcache.servers.split(',')
-        self._memcache_client = memcache.Client(memcache_servers, debug=0)
+        self._memcache_client = memcache.Client(memcache_servers, debug=0,
+                                                cache_cas=True)
         return self._memcache_client
 
     def _prefix_token_id(self, token_id):
@@ -61,6 +67,15 @@ class Token(token.Driver):
 
         return token
 
+    def get_tokens(self, token_ids):
+        keys = dict((self._prefix_token_id(self.token_to_key(token_id)),
+                     token_id)
+                    for token_id in token_ids if token_id is not None)
+        if not keys:
+            return {}
+        tokens = self.client.get_multi(keys.keys())
+        return dict((keys[key], token) for key, token in tokens.iteritems())
+
     def create_token(self, token_id, data):
         data_copy = copy.deepcopy(data)
         ptk = self._prefix_token_id(self.token_to_key(token_id))
@@ -72,53 +87,257 @@ class Token(token.Driver):
             kwargs['time'] = expires_ts
         self.client.set(ptk, data_copy, **kwargs)
         if 'id' in data['user']:
-            token_data = jsonutils.dumps(token_id)
             user_id = data['user']['id']
             user_key = self._prefix_user_id(user_id)
-            if not self.client.append(user_key, ',%s' % token_data):
-                if not self.client.add(user_key, token_data):
-                    if not self.client.append(user_key, ',%s' % token_data):
-                        msg = _('Unable to add token user list.')
-                        raise exception.UnexpectedError(msg)
+            self._update_user_list_with_cas(user_key,
+                                            self.token_to_key(token_id),
+                                            kwargs.get('time'))
         return copy.deepcopy(data_copy)
 
-    def _add_to_revocation_list(self, data):
-        data_json = jsonutils.dumps(data)
-        if not self.client.append(self.revocation_key, ',%s' % data_json):
-            if not self.client.add(self.revocation_key, data_json):
-                if not self.client.append(self.revocation_key,
-                                          ',%s' % data_json):
-                    msg = _('Unable to add token to revocation list.')
-                    raise exception.UnexpectedError(msg)
+    def _get_user_list(self, user_key):
+        """Reads a user's token index so that it can be updated with CAS.
+
+        Each entry of the index is a [token_id, expires] pair, where expires
+        is a unix timestamp or null for a token which never expires. Entries
+        written before expiry times were indexed are bare token ids; their
+        expiry is read from the tokens themselves, and they are dropped if
+        the token is gone.
+
+        :returns: list of (token_id, expires) tuples, or None if the user has
+                  no index yet
+
+        """
+        user_record = self.client.gets(user_key)
+        if user_record is None:
+            return None
+        entries = jsonutils.loads('[%s]' % user_record.lstrip(','))
+        # legacy entries may be raw PKI token ids, too long to be keys
+        entries = [self.token_to_key(entry)
+                   if isinstance(entry, basestring) else entry
+                   for entry in entries]
+        legacy_ids = [entry for entry in entries
+                      if isinstance(entry, basestring)]
+        legacy_expires = {}
+        if legacy_ids:
+            for token_id, token_ref in self._get_live_tokens(legacy_ids):
+                expires = token_ref.get('expires')
+                legacy_expires[token_id] = (utils.unixtime(expires)
+                                            if expires is not None else None)
+        token_ids = []
+        for entry in entries:
+            if not isinstance(entry, basestring):
+                token_ids.append(tuple(entry))
+            elif entry in legacy_expires:
+                token_ids.append((entry, legacy_expires[entry]))
+        return token_ids
+
+    def _set_user_list(self, user_key, token_ids):
+        user_record = ','.join(jsonutils.dumps(list(entry))
+                               for entry in token_ids)
+        return self.client.cas(user_key, user_record)
+
+    def _get_live_tokens(self, token_ids):
+        """Fetches all of the given tokens in a single round trip.
+
+        Tokens which memcached has already expired (or which were deleted)
+        are dropped.
+
+        :returns: list of (token_id, token_ref) tuples
+
+        """
+        ptks = [self._prefix_token_id(token_id) for token_id in token_ids]
+        token_refs = self.client.get_multi(ptks) if ptks else {}
+        return [(token_id, token_refs[ptk])
+                for token_id, ptk in zip(token_ids, ptks)
+                if ptk in token_refs]
+
+    def _update_user_list_with_cas(self, user_key, token_id, expires):
+        token_data = jsonutils.dumps([token_id, expires])
+        for attempt in xrange(CONF.memcache.max_compare_and_set_retry):
+            token_ids = self._get_user_list(user_key)
+            if token_ids is None:
+                if self.client.add(user_key, token_data):
+                    return
+                continue
+            # compact the index on write using the indexed expiry times, so
+            # that it only references unexpired tokens without fetching them
+            now = utils.unixtime(timeutils.utcnow())
+            token_ids = [(live_id, live_expires)
+                         for live_id, live_expires in token_ids
+                         if live_expires is None or live_expires > now]
+            token_ids.append((token_id, expires))
+            if self._set_user_list(user_key, token_ids):
+                return
+        msg = _('Unable to add token user list.')
+        raise exception.UnexpectedError(msg)
+
+    def _prefix_revocation_bucket(self, bucket):
+        return '%s-%d' % (self.revocation_key, bucket)
+
+    def _revocation_bucket(self, expires):
+        return int(utils.unixtime(expires)) // self.revocation_bucket_seconds
+
+    def _add_to_revocation_list(self, tokens):
+        """Records revoked tokens in the buckets of their expiry time.
+
+        Each bucket key is stored with a memcache expiry at the end of its
+        period, so revocations disappear together with the tokens they
+        refer to. Tokens which never expire, or which outlive the buckets
+        read by list_revoked_tokens, are kept in the unbucketed list that is
+        pruned by flush_expired_tokens.
+
+        :param tokens: list of (token_id, expires) tuples; the tokens sharing
+                       a bucket are appended to it in a single call
+
+        """
+        max_expires = self._get_default_expire_time()
+        now = timeutils.utcnow()
+        buckets = {}
+        for token_id, expires in tokens:
+            kwargs = {}
+            if expires is None or expires > max_expires:
+                key = self.revocation_key
+            else:
+                bucket = self._revocation_bucket(expires)
+                key = self._prefix_revocation_bucket(bucket)
+                kwargs['time'] = (bucket + 1) * self.revocation_bucket_seconds
+            data_json = jsonutils.dumps({'id': token_id,
+                                         'expires': expires,
+                                         'revoked_at': now})
+            buckets.setdefault(key, ([], kwargs))[0].append(data_json)
+
+        for key, (records, kwargs) in buckets.iteritems():
+            data_json = ','.join(records)
+            if not self.client.append(key, ',%s' % data_json):
+                if not self.client.add(key, data_json, **kwargs):
+                    if not self.client.append(key, ',%s' % data_json):
+                        msg = _('Unable to add token to revocation list.')
+                        raise exception.UnexpectedError(msg)
+
+    def _load_revocation_list(self, list_json):
+        records = jsonutils.loads('[%s]' % list_json.lstrip(','))
+        for record in records:
+            for field in ('expires', 'revoked_at'):
+                if record.get(field):
+                    record[field] = timeutils.parse_strtime(record[field])
+        return records
 
     def delete_token(self, token_id):
         # Test for existence
-        data = self.get_token(self.token_to_key(token_id))
-        ptk = self._prefix_token_id(self.token_to_key(token_id))
+        token_id = self.token_to_key(token_id)
+        data = self.get_token(token_id)
+        ptk = self._prefix_token_id(token_id)
         result = self.client.delete(ptk)
-        self._add_to_revocation_list(data)
+        self._add_to_revocation_list([(token_id, data.get('expires'))])
+        self._bump_revocation_generation()
         return result
 
+    def revoke_tokens(self, user_id, tenant_id=None):
+        user_key = self._prefix_user_id(user_id)
+        token_ids = self._get_user_list(user_key)
+        if not token_ids:
+            return
+        expires = dict(token_ids)
+        live_tokens = self._get_live_tokens(
+            [token_id for token_id, _expires in token_ids])
+        revoked_tokens = [(token_id, token_ref)
+                          for token_id, token_ref in live_tokens
+                          if tenant_id is None or
+                          (token_ref.get('tenant') or {}).get('id') ==
+                          tenant_id]
+        if revoked_tokens:
+            self.client.delete_multi([self._prefix_token_id(token_id)
+                                      for token_id, _ref in revoked_tokens])
+            self._add_to_revocation_list(
+                [(token_id, token_ref.get('expires'))
+                 for token_id, token_ref in revoked_tokens])
+            self._bump_revocation_generation()
+        revoked_ids = set(token_id for token_id, _ref in revoked_tokens)
+        remaining_ids = [(token_id, expires[token_id])
+                         for token_id, _ref in live_tokens
+                         if token_id not in revoked_ids]
+        if len(remaining_ids) < len(token_ids):
+            # best effort compaction, as in list_tokens
+            self._set_user_list(user_key, remaining_ids)
+
+    def _bump_revocation_generation(self):
+        key = self.revocation_generation_key
+        if self.client.incr(key) is None:
+            # seed a missing (or evicted) counter from the clock so that it
+            # never goes back to a generation a reader may have cached
+            if not self.client.add(key, int(time.time())):
+                self.client.incr(key)
+
+    def get_revocation_generation(self):
+        return int(self.client.get(self.revocation_generation_key) or 0)
+
     def list_tokens(self, user_id, tenant_id=None):
         tokens = []
         user_key = self._prefix_user_id(user_id)
-        user_record = self.client.get(user_key) or ""
-        token_list = jsonutils.loads('[%s]' % user_record)
-        for token_id in token_list:
-            ptk = self._prefix_token_id(token_id)
-            token_ref = self.client.get(ptk)
-            if token_ref:
-                if tenant_id is not None:
-                    tenant = token_ref.get('tenant')
-                    if not tenant:
-                        continue
-                    if tenant.get('id') != tenant_id:
-                        continue
-                tokens.append(token_id)
+        token_ids = self._get_user_list(user_key)
+        if not token_ids:
+            return tokens
+        expires = dict(token_ids)
+        live_tokens = self._get_live_tokens(
+            [token_id for token_id, _expires in token_ids])
+        if len(live_tokens) < len(token_ids):
+            # best effort compaction; if a token was added concurrently the
+            # CAS fails and the index is compacted on the next access
+            self._set_user_list(user_key,
+                                [(token_id, expires[token_id])
+                                 for token_id, _ref in live_tokens])
+        for token_id, token_ref in live_tokens:
+            if tenant_id is not None:
+                tenant = token_ref.get('tenant')
+                if not tenant:
+                    continue
+                if tenant.get('id') != tenant_id:
+                    continue
+            tokens.append(token_id)
         return tokens
 
-    def list_revoked_tokens(self):
-        list_json = self.client.get(self.revocation_key)
-        if list_json:
-            return jsonutils.loads('[%s]' % list_json)
-        return []
+    def list_revoked_tokens(self, since=None):
+        now = timeutils.utcnow()
+        first_bucket = self._revocation_bucket(now)
+        last_bucket = self._revocation_bucket(self._get_default_expire_time())
+        keys = [self.revocation_key]
+        keys.extend(self._prefix_revocation_bucket(bucket)
+                    for bucket in xrange(first_bucket, last_bucket + 1))
+        tokens = []
+        for list_json in self.client.get_multi(keys).itervalues():
+            if not list_json:
+                continue
+            for record in self._load_revocation_list(list_json):
+                if record.get('expires') and record['expires'] < now:
+                    continue
+                if since is not None and (record.get('revoked_at') is None or
+                                          record['revoked_at'] < since):
+                    continue
+                tokens.append(record)
+        return tokens
+
+    def flush_expired_tokens(self):
+        """Prunes expired entries from the unbucketed revocation list.
+
+        Token keys and revocation list buckets are stored with a memcache
+        expiry time, so the unbucketed revocation list is the only record
+        that needs to be purged.
+
+        """
+        now = timeutils.utcnow()
+        while True:
+            list_json = self.client.gets(self.revocation_key)
+            if not list_json:
+                return 0
+            records = self._load_revocation_list(list_json)
+            live_records = [record for record in records
+                            if not record.get('expires') or
+                            record['expires'] > now]
+            if len(live_records) == len(records):
+                return 0
+            list_json = ','.join(jsonutils.dumps(record)
+                                 for record in live_records)
+            # a concurrent revocation invalidates the CAS id, in which case
+            # the list is simply re-read so that no revocation is lost
+            if self.client.cas(self.revocation_key, list_json):
+                return len(records) - len(live_records)
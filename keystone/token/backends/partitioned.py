@@ -0,0 +1,329 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""SQL token driver storing tokens in one table per period of expiry.
+
+Tokens are written to a ``token_p_<YYYYmmddHHMM>`` table, named after the
+start of the ``[token] partition_seconds`` period in which they expire.
+Expired tokens are removed by dropping whole tables rather than deleting
+rows, so purging them costs the same however many tokens were issued.
+
+Tokens which never expire, or which expire after ``[token] expiration``
+seconds from now, go to the ``token_p_overflow`` table, which is purged row
+by row like the ``token`` table of the default SQL driver.
+
+Partitions are created a period before tokens start being written to them,
+by ``flush_expired_tokens`` and by the first token written in each period,
+so that processes do not all race to create them as a period starts. Reads
+never create tables: a partition which does not exist holds no tokens.
+
+"""
+
+import calendar
+import copy
+import datetime
+import time
+
+from keystone.common import sql
+from keystone import config
+from keystone import exception
+from keystone.openstack.common import timeutils
+from keystone.token.backends import sql as token_sql
+
+
+CONF = config.CONF
+config.register_int('partition_seconds', group='token', default=3600)
+
+PARTITION_PREFIX = 'token_p_'
+OVERFLOW_PARTITION = PARTITION_PREFIX + 'overflow'
+
+
+class Token(token_sql.Token):
+    def __init__(self):
+        super(Token, self).__init__()
+        # partitions are named after the minute their period starts at
+        if (CONF.token.partition_seconds < 60 or
+                CONF.token.partition_seconds % 60):
+            raise ValueError('[token] partition_seconds must be a multiple'
+                             ' of 60: %s' % CONF.token.partition_seconds)
+        self._metadata = sql.MetaData()
+        # partitions known to exist
+        self._partitions = set()
+        # period in which the upcoming partitions were last created
+        self._created_period = None
+
+    def _get_engine(self):
+        self._engine = self._engine or self.get_engine()
+        return self._engine
+
+    def _period(self, expires):
+        return (calendar.timegm(expires.utctimetuple()) //
+                CONF.token.partition_seconds)
+
+    def _partition_name(self, period):
+        start = datetime.datetime.utcfromtimestamp(
+            period * CONF.token.partition_seconds)
+        return PARTITION_PREFIX + start.strftime('%Y%m%d%H%M')
+
+    def _partition_period(self, name):
+        start = datetime.datetime.strptime(name[len(PARTITION_PREFIX):],
+                                           '%Y%m%d%H%M')
+        return self._period(start)
+
+    def _table(self, name):
+        table = self._metadata.tables.get(name)
+        if table is None:
+            table = sql.Table(
+                name, self._metadata,
+                sql.Column('id', sql.String(64), primary_key=True),
+                sql.Column('expires', sql.DateTime(), default=None),
+                sql.Column('extra', sql.JsonBlob()),
+                sql.Column('valid', sql.Boolean(), default=True),
+                sql.Column('user_id', sql.String(64), index=True),
+                sql.Column('tenant_id', sql.String(64), index=True),
+                sql.Column('revoked_at', sql.DateTime(), index=True))
+        return table
+
+    def _refresh_partitions(self):
+        self._partitions.update(
+            name for name in self._get_engine().table_names()
+            if name.startswith(PARTITION_PREFIX))
+
+    def _partition(self, name):
+        """Returns the table of a partition, creating it if needed.
+
+        Another process may create the same partition concurrently, in which
+        case the table exists although creating it failed.
+
+        """
+        table = self._table(name)
+        if name not in self._partitions:
+            engine = self._get_engine()
+            try:
+                table.create(bind=engine, checkfirst=True)
+            except sql.DBAPIError:
+                if not engine.has_table(name):
+                    raise
+            self._partitions.add(name)
+        return table
+
+    def _create_partitions(self):
+        """Creates the partitions of every live period and of the next one."""
+        now = timeutils.utcnow()
+        self._refresh_partitions()
+        first = self._period(now)
+        last = self._period(
+            now + datetime.timedelta(seconds=CONF.token.expiration))
+        for period in range(first, last + 2):
+            self._partition(self._partition_name(period))
+        self._partition(OVERFLOW_PARTITION)
+        self._created_period = first
+
+    def _live_partitions(self):
+        """Returns the existing tables which may hold unexpired tokens.
+
+        That is the tables of every period from now to ``[token] expiration``
+        seconds from now, and the overflow partition.
+
+        """
+        now = timeutils.utcnow()
+        first = self._period(now)
+        last = self._period(
+            now + datetime.timedelta(seconds=CONF.token.expiration))
+        names = [self._partition_name(period)
+                 for period in range(first, last + 1)]
+        names.append(OVERFLOW_PARTITION)
+        if not self._partitions.issuperset(names):
+            # created by another process, or holding no tokens yet
+            self._refresh_partitions()
+        return [self._table(name) for name in names
+                if name in self._partitions]
+
+    def _partition_for(self, expires):
+        if self._created_period != self._period(timeutils.utcnow()):
+            self._create_partitions()
+        if expires is not None:
+            now = timeutils.utcnow()
+            period = self._period(expires)
+            if period <= self._period(
+                    now + datetime.timedelta(seconds=CONF.token.expiration)):
+                return self._partition(self._partition_name(period))
+        return self._partition(OVERFLOW_PARTITION)
+
+    def _select(self, session, columns, *criteria):
+        """Runs a query across the live partitions in one round trip.
+
+        Each row has a trailing ``partition`` column naming its table.
+
+        """
+        selects = []
+        for table in self._live_partitions():
+            query = sql.select([table.c[column] for column in columns] +
+                               [sql.literal(table.name).label('partition')])
+            for criterion in criteria:
+                query = query.where(criterion(table))
+            selects.append(query)
+        if not selects:
+            return []
+        return session.execute(sql.union_all(*selects)).fetchall()
+
+    def _to_dict(self, row):
+        token_ref = dict(row['extra'] or {})
+        token_ref['id'] = row['id']
+        token_ref['expires'] = row['expires']
+        return token_ref
+
+    def _live(self, table):
+        return sql.or_(table.c.expires > timeutils.utcnow(),
+                       table.c.expires == sql.null())
+
+    # Public interface
+    def get_token(self, token_id):
+        if token_id is None:
+            raise exception.TokenNotFound(token_id=token_id)
+        token_refs = self.get_tokens([token_id])
+        if token_id not in token_refs:
+            raise exception.TokenNotFound(token_id=token_id)
+        return token_refs[token_id]
+
+    def get_tokens(self, token_ids):
+        keys = dict((self.token_to_key(token_id), token_id)
+                    for token_id in token_ids if token_id is not None)
+        if not keys:
+            return {}
+        session = self.get_session()
+        rows = self._select(session, ['id', 'expires', 'extra'],
+                            lambda t: t.c.id.in_(keys.keys()),
+                            lambda t: t.c.valid,
+                            self._live)
+        return dict((keys[row['id']], self._to_dict(row)) for row in rows)
+
+    def create_token(self, token_id, data):
+        data_copy = copy.deepcopy(data)
+        if 'expires' not in data_copy:
+            data_copy['expires'] = self._get_default_expire_time()
+        token_ref = token_sql.TokenModel.from_dict(data_copy)
+        table = self._partition_for(data_copy['expires'])
+        session = self.get_session()
+        with session.begin():
+            session.execute(table.insert().values(
+                id=self.token_to_key(token_id),
+                expires=token_ref.expires,
+                extra=token_ref.extra,
+                valid=True,
+                user_id=(data_copy.get('user') or {}).get('id'),
+                tenant_id=(data_copy.get('tenant') or {}).get('id')))
+        return token_ref.to_dict()
+
+    def delete_token(self, token_id):
+        session = self.get_session()
+        key = self.token_to_key(token_id)
+        with session.begin():
+            rows = self._select(session, ['id'],
+                                lambda t: t.c.id == key,
+                                lambda t: t.c.valid)
+            if not rows:
+                raise exception.TokenNotFound(token_id=token_id)
+            table = self._table(rows[0]['partition'])
+            session.execute(table.update()
+                            .where(table.c.id == key)
+                            .values(valid=False,
+                                    revoked_at=timeutils.utcnow()))
+            self._bump_revocation_generation(session)
+
+    def revoke_tokens(self, user_id, tenant_id=None):
+        session = self.get_session()
+        now = timeutils.utcnow()
+        with session.begin():
+            revoked = 0
+            for table in self._live_partitions():
+                query = table.update().where(table.c.user_id == user_id)
+                query = query.where(table.c.valid)
+                if tenant_id is not None:
+                    query = query.where(table.c.tenant_id == tenant_id)
+                query = query.where(self._live(table))
+                revoked += session.execute(
+                    query.values(valid=False, revoked_at=now)).rowcount
+            if revoked:
+                self._bump_revocation_generation(session)
+
+    def list_tokens(self, user_id, tenant_id=None):
+        session = self.get_session()
+        criteria = [lambda t: t.c.user_id == user_id,
+                    lambda t: t.c.valid,
+                    lambda t: t.c.expires > timeutils.utcnow()]
+        if tenant_id is not None:
+            criteria.append(lambda t: t.c.tenant_id == tenant_id)
+        return [row['id']
+                for row in self._select(session, ['id'], *criteria)]
+
+    def list_revoked_tokens(self, since=None):
+        session = self.get_session()
+        criteria = [lambda t: sql.not_(t.c.valid),
+                    lambda t: t.c.expires > timeutils.utcnow()]
+        if since is not None:
+            criteria.append(lambda t: t.c.revoked_at >= since)
+        rows = self._select(session, ['id', 'expires', 'revoked_at'],
+                            *criteria)
+        return [{'id': row['id'],
+                 'expires': row['expires'],
+                 'revoked_at': row['revoked_at']}
+                for row in rows]
+
+    def flush_expired_tokens(self):
+        """Drops the partitions of periods which ended a period ago.
+
+        Keeping the partition of the period which just ended leaves time
+        for processes whose clocks lag behind to stop reading it. The
+        partitions of upcoming periods are created at the same time.
+
+        :returns: number of tokens deleted from the overflow partition; the
+                  tokens of dropped partitions are not counted, as counting
+                  them would mean reading the whole partitions
+
+        """
+        self._create_partitions()
+        engine = self._get_engine()
+        last_expired = self._period(timeutils.utcnow()) - 2
+        for name in engine.table_names():
+            if (not name.startswith(PARTITION_PREFIX) or
+                    name == OVERFLOW_PARTITION or
+                    self._partition_period(name) > last_expired):
+                continue
+            table = self._table(name)
+            table.drop(bind=engine, checkfirst=True)
+            self._metadata.remove(table)
+            self._partitions.discard(name)
+        return self._flush_overflow()
+
+    def _flush_overflow(self):
+        table = self._partition(OVERFLOW_PARTITION)
+        session = self.get_session()
+        batch_size = CONF.token.flush_batch_size
+        count = 0
+        while True:
+            with session.begin():
+                query = sql.select([table.c.id])
+                query = query.where(table.c.expires < timeutils.utcnow())
+                token_ids = [row['id'] for row in session.execute(
+                    query.limit(batch_size))]
+                if token_ids:
+                    session.execute(table.delete().where(
+                        table.c.id.in_(token_ids)))
+            count += len(token_ids)
+            if len(token_ids) < batch_size:
+                return count
+            time.sleep(CONF.token.flush_batch_delay)
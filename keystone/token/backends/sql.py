@@ -14,16 +14,35 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import atexit
 import copy
 import datetime
+import threading
+import time
 
-
+from keystone.common import logging
 from keystone.common import sql
+from keystone import config
 from keystone import exception
 from keystone.openstack.common import timeutils
 from keystone import token
 
 
+CONF = config.CONF
+LOG = logging.getLogger(__name__)
+config.register_bool('write_behind', group='token', default=False)
+config.register_float('write_behind_interval', group='token', default=0.05)
+config.register_int('write_behind_batch_size', group='token', default=100)
+config.register_int('write_behind_queue_size', group='token', default=10000)
+
+# process-wide buffer of tokens waiting to be written
+_BUFFER = None
+
+# errors after which buffered tokens are kept, to be written once the
+# database is back
+_DATABASE_UNAVAILABLE = (sql.OperationalError, sql.DisconnectionError)
+
+
 class TokenModel(sql.ModelBase, sql.DictBase):
     __tablename__ = 'token'
     attributes = ['id', 'expires']
@@ -31,13 +50,164 @@ class TokenModel(sql.ModelBase, sql.DictBase):
     expires = sql.Column(sql.DateTime(), default=None)
     extra = sql.Column(sql.JsonBlob())
     valid = sql.Column(sql.Boolean(), default=True)
+    user_id = sql.Column(sql.String(64), index=True)
+    tenant_id = sql.Column(sql.String(64), index=True)
+    revoked_at = sql.Column(sql.DateTime(), index=True)
+
+
+class RevocationGeneration(sql.ModelBase, sql.DictBase):
+    """Counter bumped whenever the set of revoked tokens changes."""
+    __tablename__ = 'revocation_generation'
+    id = sql.Column(sql.String(64), primary_key=True)
+    generation = sql.Column(sql.Integer(), nullable=False)
+
+
+class WriteBehindBuffer(object):
+    """Tokens which have been issued but not yet written to the database.
+
+    A background thread writes the buffered tokens every
+    ``[token] write_behind_interval`` seconds, or as soon as
+    ``[token] write_behind_batch_size`` of them are waiting, in batches of
+    at most that many rows. Once ``[token] write_behind_queue_size`` tokens
+    are waiting, issuing a token writes the buffer out first, so that a
+    lagging database slows token issuance down rather than letting the
+    buffer grow, and an unavailable one fails it.
+
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # token_ref and row by token key, and the keys in issue order
+        self._tokens = {}
+        self._order = []
+        self._closed = False
+        writer = threading.Thread(target=self._run)
+        writer.daemon = True
+        writer.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._order)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(CONF.token.write_behind_interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception('Unable to write buffered tokens')
+
+    def close(self):
+        """Stops the background writer and writes any buffered tokens."""
+        self._closed = True
+        self._wakeup.set()
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception('Unable to write %d buffered tokens' % len(self))
+
+    def add(self, key, token_ref, row):
+        if len(self) >= CONF.token.write_behind_queue_size:
+            # raises, without buffering the token, if the database is down
+            self.flush()
+        with self._lock:
+            if key not in self._tokens:
+                self._order.append(key)
+            self._tokens[key] = (token_ref, row)
+            waiting = len(self._order)
+        if waiting >= CONF.token.write_behind_batch_size:
+            self._wakeup.set()
+
+    def get(self, key):
+        with self._lock:
+            token_ref, row = self._tokens.get(key, (None, None))
+        return token_ref
+
+    def _discard(self, count):
+        """Forgets the oldest buffered tokens, once written."""
+        with self._lock:
+            for key in self._order[:count]:
+                del self._tokens[key]
+            del self._order[:count]
+
+    def _write_each(self, rows):
+        """Writes rows one at a time, dropping those which fail."""
+        for row in rows:
+            try:
+                self._write([row])
+            except _DATABASE_UNAVAILABLE:
+                raise
+            except Exception:
+                LOG.exception('Dropping a buffered token which cannot be'
+                              ' written')
+            self._discard(1)
+
+    def flush(self):
+        """Writes every buffered token, in batches.
+
+        If a batch fails, its rows are written one at a time and the rows
+        which still fail are dropped, so that a token which can never be
+        written does not hold back the tokens issued after it. Tokens are
+        only kept buffered if the database is unavailable.
+
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    keys = self._order[:CONF.token.write_behind_batch_size]
+                    rows = [self._tokens[key][1] for key in keys]
+                if not rows:
+                    return
+                try:
+                    self._write(rows)
+                except _DATABASE_UNAVAILABLE:
+                    raise
+                except Exception:
+                    LOG.warning('Unable to write %d buffered tokens at once,'
+                                ' writing them one by one' % len(rows))
+                    self._write_each(rows)
+                else:
+                    self._discard(len(keys))
 
 
 class Token(sql.Base, token.Driver):
+    def _buffer(self):
+        """Returns the write-behind buffer, if enabled."""
+        global _BUFFER
+        if not CONF.token.write_behind:
+            return None
+        if _BUFFER is None:
+            _BUFFER = WriteBehindBuffer(self._write_tokens)
+        return _BUFFER
+
+    def _flush_buffer(self):
+        """Writes buffered tokens out before reading or updating tokens."""
+        if _BUFFER is not None and len(_BUFFER):
+            _BUFFER.flush()
+
+    def _write_tokens(self, rows):
+        session = self.get_session()
+        with session.begin():
+            # executemany; drivers such as MySQLdb send it as a single
+            # multi-row INSERT
+            session.execute(TokenModel.__table__.insert(), rows)
+
     # Public interface
     def get_token(self, token_id):
         if token_id is None:
             raise exception.TokenNotFound(token_id=token_id)
+        if _BUFFER is not None:
+            token_ref = _BUFFER.get(self.token_to_key(token_id))
+            if token_ref is not None and (
+                    not token_ref['expires'] or
+                    timeutils.utcnow() < token_ref['expires']):
+                return copy.deepcopy(token_ref)
         session = self.get_session()
         query = session.query(TokenModel)
         query = query.filter_by(id=self.token_to_key(token_id), valid=True)
@@ -48,6 +218,21 @@ class Token(sql.Base, token.Driver):
         else:
             raise exception.TokenNotFound(token_id=token_id)
 
+    def get_tokens(self, token_ids):
+        self._flush_buffer()
+        keys = dict((self.token_to_key(token_id), token_id)
+                    for token_id in token_ids if token_id is not None)
+        if not keys:
+            return {}
+        session = self.get_session()
+        query = session.query(TokenModel)
+        query = query.filter(TokenModel.id.in_(keys.keys()))
+        query = query.filter_by(valid=True)
+        now = timeutils.utcnow()
+        return dict((keys[token_ref.id], token_ref.to_dict())
+                    for token_ref in query
+                    if not token_ref.expires or now < token_ref.expires)
+
     def create_token(self, token_id, data):
         data_copy = copy.deepcopy(data)
         if 'expires' not in data_copy:
@@ -56,6 +241,14 @@ class Token(sql.Base, token.Driver):
         token_ref = TokenModel.from_dict(data_copy)
         token_ref.id = self.token_to_key(token_id)
         token_ref.valid = True
+        token_ref.user_id = (data_copy.get('user') or {}).get('id')
+        token_ref.tenant_id = (data_copy.get('tenant') or {}).get('id')
+        buffer = self._buffer()
+        if buffer is not None:
+            buffer.add(token_ref.id, token_ref.to_dict(),
+                       dict((column.name, getattr(token_ref, column.name))
+                            for column in TokenModel.__table__.columns))
+            return token_ref.to_dict()
         session = self.get_session()
         with session.begin():
             session.add(token_ref)
@@ -63,6 +256,7 @@ class Token(sql.Base, token.Driver):
         return token_ref.to_dict()
 
     def delete_token(self, token_id):
+        self._flush_buffer()
         session = self.get_session()
         key = self.token_to_key(token_id)
         with session.begin():
@@ -71,42 +265,86 @@ class Token(sql.Base, token.Driver):
             if not token_ref:
                 raise exception.TokenNotFound(token_id=token_id)
             token_ref.valid = False
+            token_ref.revoked_at = timeutils.utcnow()
+            self._bump_revocation_generation(session)
             session.flush()
 
+    def revoke_tokens(self, user_id, tenant_id=None):
+        self._flush_buffer()
+        session = self.get_session()
+        now = timeutils.utcnow()
+        with session.begin():
+            query = session.query(TokenModel)
+            query = query.filter_by(user_id=user_id, valid=True)
+            if tenant_id is not None:
+                query = query.filter_by(tenant_id=tenant_id)
+            query = query.filter(sql.or_(TokenModel.expires > now,
+                                         TokenModel.expires == sql.null()))
+            if query.update({'valid': False, 'revoked_at': now},
+                            synchronize_session=False):
+                self._bump_revocation_generation(session)
+
+    def _bump_revocation_generation(self, session):
+        query = session.query(RevocationGeneration).filter_by(id='token')
+        updated = query.update(
+            {'generation': RevocationGeneration.generation + 1},
+            synchronize_session=False)
+        if not updated:
+            session.add(RevocationGeneration(id='token', generation=1))
+
+    def get_revocation_generation(self):
+        session = self.get_session()
+        query = session.query(RevocationGeneration.generation)
+        generation_ref = query.filter_by(id='token').first()
+        return generation_ref.generation if generation_ref else 0
+
     def list_tokens(self, user_id, tenant_id=None):
+        self._flush_buffer()
         session = self.get_session()
-        tokens = []
         now = timeutils.utcnow()
-        query = session.query(TokenModel)
+        query = session.query(TokenModel.id)
         query = query.filter(TokenModel.expires > now)
-        token_references = query.filter_by(valid=True)
-        for token_ref in token_references:
-            token_ref_dict = token_ref.to_dict()
-            user = token_ref_dict.get('user')
-            if not user:
-                continue
-            if user.get('id') != user_id:
-                continue
-            if tenant_id is not None:
-                tenant = token_ref_dict.get('tenant')
-                if not tenant:
-                    continue
-                if tenant.get('id') != tenant_id:
-                    continue
-            tokens.append(token_ref['id'])
-        return tokens
+        query = query.filter_by(user_id=user_id, valid=True)
+        if tenant_id is not None:
+            query = query.filter_by(tenant_id=tenant_id)
+        return [token_ref.id for token_ref in query]
 
-    def list_revoked_tokens(self):
+    def list_revoked_tokens(self, since=None):
+        self._flush_buffer()
         session = self.get_session()
         tokens = []
         now = timeutils.utcnow()
         query = session.query(TokenModel)
         query = query.filter(TokenModel.expires > now)
+        if since is not None:
+            query = query.filter(TokenModel.revoked_at >= since)
         token_references = query.filter_by(valid=False)
         for token_ref in token_references:
             record = {
                 'id': token_ref['id'],
                 'expires': token_ref['expires'],
+                'revoked_at': token_ref['revoked_at'],
             }
             tokens.append(record)
         return tokens
+
+    def flush_expired_tokens(self):
+        self._flush_buffer()
+        session = self.get_session()
+        batch_size = CONF.token.flush_batch_size
+        count = 0
+        while True:
+            now = timeutils.utcnow()
+            with session.begin():
+                query = session.query(TokenModel.id)
+                query = query.filter(TokenModel.expires < now)
+                token_ids = [token_ref.id
+                             for token_ref in query.limit(batch_size)]
+                if token_ids:
+                    query = session.query(TokenModel)
+                    query = query.filter(TokenModel.id.in_(token_ids))
+                    query.delete(synchronize_session=False)
+            count += len(token_ids)
+            if len(token_ids) < batch_size:
+                return count
+            time.sleep(CONF.token.flush_batch_delay)
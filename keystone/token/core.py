@@ -16,10 +16,12 @@
 
 """Main entry point into the Token service."""
 
+import copy
 import datetime
 
 from keystone.common import manager
 from keystone.common import cms
+from keystone.common import utils
 from keystone import config
 from keystone import exception
 from keystone.openstack.common import timeutils
@@ -27,6 +29,37 @@ from keystone.openstack.common import timeutils
 
 CONF = config.CONF
 config.register_int('expiration', group='token', default=86400)
+config.register_int('flush_batch_size', group='token', default=1000)
+config.register_float('flush_batch_delay', group='token', default=0.5)
+config.register_int('revocation_list_max_age', group='token', default=0)
+config.register_int('revocation_list_overlap', group='token', default=300)
+config.register_int('cache_size', group='token', default=0)
+config.register_int('cache_time', group='token', default=60)
+config.register_bool('live_validation', group='token', default=False)
+config.register_bool('reuse', group='token', default=False)
+config.register_int('reuse_min_lifetime', group='token', default=3600)
+config.register_int('revocation_filter_capacity', group='token',
+                    default=10000)
+config.register_float('revocation_filter_error_rate', group='token',
+                      default=0.001)
+
+
+_CACHE = None
+
+
+def token_cache():
+    """Returns the process-wide token cache, or None if it is disabled.
+
+    The cache is shared by every Manager in the process, and is rebuilt
+    whenever ``[token] cache_size`` changes.
+
+    """
+    global _CACHE
+    if CONF.token.cache_size <= 0:
+        _CACHE = None
+    elif _CACHE is None or _CACHE.max_size != CONF.token.cache_size:
+        _CACHE = utils.LRUCache(CONF.token.cache_size)
+    return _CACHE
 
 
 class Manager(manager.Manager):
@@ -39,15 +72,150 @@ class Manager(manager.Manager):
 
     def __init__(self):
         super(Manager, self).__init__(CONF.token.driver)
+        # (revocation generation, bloom filter, revocation list cursor)
+        self._revocation_filter = None
+
+    def get_token(self, context, token_id):
+        """Get a token by id, through the token cache if it is enabled.
+
+        Deleting or revoking tokens evicts them from the cache of the process
+        doing so only; other processes may keep serving a token for up to
+        ``[token] cache_time`` seconds, and never past its expiry.
+
+        """
+        cache = token_cache()
+        if cache is None or token_id is None:
+            return self.driver.get_token(token_id)
+
+        key = self.driver.token_to_key(token_id)
+        token_ref = cache.get(key)
+        if token_ref is None:
+            token_ref = self.driver.get_token(token_id)
+            expires = (timeutils.utcnow() +
+                       datetime.timedelta(seconds=CONF.token.cache_time))
+            if token_ref.get('expires') is not None:
+                expires = min(expires, token_ref['expires'])
+            cache.set(key, token_ref, expires)
+        # callers are free to modify the token they are handed
+        return copy.deepcopy(token_ref)
+
+    def get_tokens(self, context, token_ids):
+        """Get many tokens at once, through the token cache if enabled.
+
+        :returns: dict of token_ref by token id, without the tokens which
+                  could not be found
+
+        """
+        cache = token_cache()
+        if cache is None:
+            return self.driver.get_tokens(token_ids)
+
+        token_refs = {}
+        missing = []
+        for token_id in token_ids:
+            token_ref = cache.get(self.driver.token_to_key(token_id))
+            if token_ref is None:
+                missing.append(token_id)
+            else:
+                token_refs[token_id] = copy.deepcopy(token_ref)
+        if missing:
+            now = timeutils.utcnow()
+            for token_id, token_ref in self.driver.get_tokens(
+                    missing).iteritems():
+                expires = now + datetime.timedelta(
+                    seconds=CONF.token.cache_time)
+                if token_ref.get('expires') is not None:
+                    expires = min(expires, token_ref['expires'])
+                cache.set(self.driver.token_to_key(token_id), token_ref,
+                          expires)
+                token_refs[token_id] = copy.deepcopy(token_ref)
+        return token_refs
+
+    def delete_token(self, context, token_id):
+        key = self.driver.token_to_key(token_id)
+        cache = token_cache()
+        if cache is not None:
+            cache.delete(key)
+        self.driver.delete_token(token_id)
+
+    def get_revocation_filter(self, context):
+        """Returns a bloom filter of the hashes of all revoked tokens.
+
+        Whenever the revocation generation changes, the tokens revoked since
+        the filter's cursor are added to it. Revocation times come from the
+        clocks of the processes which revoked the tokens, so the cursor
+        trails the latest revocation by ``[token] revocation_list_overlap``
+        seconds, as in the revocation list. Once full, the filter is rebuilt
+        from the full revocation list, which drops expired tokens.
+
+        :returns: (revocation generation, keystone.common.utils.BloomFilter)
+
+        """
+        generation = self.driver.get_revocation_generation()
+        if (self._revocation_filter is not None and
+                self._revocation_filter[0] == generation):
+            return self._revocation_filter[:2]
+
+        if (self._revocation_filter is None or
+                self._revocation_filter[1].is_full()):
+            bloom, until = None, None
+        else:
+            unused, bloom, until = self._revocation_filter
+        revoked = self.driver.list_revoked_tokens(since=until)
+        if bloom is None:
+            bloom = utils.BloomFilter(
+                max(CONF.token.revocation_filter_capacity, 2 * len(revoked)),
+                CONF.token.revocation_filter_error_rate)
+        overlap = datetime.timedelta(
+            seconds=CONF.token.revocation_list_overlap)
+        for t in revoked:
+            bloom.add(t['id'])
+            revoked_at = t.get('revoked_at')
+            if revoked_at is not None and (until is None or
+                                           revoked_at - overlap > until):
+                until = revoked_at - overlap
+        self._revocation_filter = (generation, bloom, until)
+        return generation, bloom
+
+    def is_revoked(self, context, token_id):
+        """Checks whether a token has been revoked.
+
+        Tokens hitting the revocation filter are confirmed by looking them
+        up in the backend, which no longer returns revoked tokens.
+
+        """
+        generation, bloom = self.get_revocation_filter(context)
+        key = self.driver.token_to_key(token_id)
+        if key not in bloom:
+            return False
+        try:
+            self.driver.get_token(key)
+        except exception.TokenNotFound:
+            return True
+        return False
+
+    def get_cache_stats(self, context):
+        """Returns hit and miss counters of the token cache, if enabled."""
+        cache = token_cache()
+        return cache.stats() if cache is not None else {}
 
     def revoke_tokens(self, context, user_id, tenant_id=None):
         """Invalidates all tokens held by a user (optionally for a tenant).
 
         If a specific tenant ID is not provided, *all* tokens held by user will
         be revoked.
+
+        Uses the driver's bulk revocation if it has one, otherwise revokes
+        the user's tokens one at a time.
         """
-        for token_id in self.list_tokens(context, user_id, tenant_id):
-            self.delete_token(context, token_id)
+        cache = token_cache()
+        if cache is not None:
+            cache.clear()
+        try:
+            self.driver.revoke_tokens(user_id, tenant_id)
+        except exception.NotImplemented:
+            for token_id in self.list_tokens(context, user_id, tenant_id):
+                self.delete_token(context, token_id)
 
 
 class Driver(object):
@@ -73,6 +241,26 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
+    def get_tokens(self, token_ids):
+        """Get many tokens by id.
+
+        Backends able to look up several tokens in one round trip should
+        override this; by default the tokens are fetched one at a time.
+
+        :param token_ids: identities of the tokens
+        :type token_ids: list
+        :returns: dict of token_ref by token id, without the tokens which
+                  could not be found
+
+        """
+        token_refs = {}
+        for token_id in token_ids:
+            try:
+                token_refs[token_id] = self.get_token(token_id)
+            except exception.TokenNotFound:
+                pass
+        return token_refs
+
     def create_token(self, token_id, data):
         """Create a token by id and data.
 
@@ -117,10 +305,12 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
-    def list_revoked_tokens(self):
+    def list_revoked_tokens(self, since=None):
         """Returns a list of all revoked tokens
 
-        :returns: list of token_id's
+        :param since: only return the tokens revoked at or after this naive
+                      utc datetime
+        :returns: list of ``{'id', 'expires', 'revoked_at'}`` records
 
         """
         raise exception.NotImplemented()
@@ -133,6 +323,30 @@ class Driver(object):
         """
         raise exception.NotImplemented()
 
+    def get_revocation_generation(self):
+        """Returns a counter which changes whenever a token is revoked.
+
+        Used to cache anything derived from the list of revoked tokens, so it
+        must be shared by all keystone processes using the backend.
+
+        :returns: integer
+
+        """
+        raise exception.NotImplemented()
+
+    def flush_expired_tokens(self):
+        """Permanently removes expired (and expired revoked) tokens.
+
+        Backends which need to delete rows explicitly do so in batches of
+        ``[token] flush_batch_size``, sleeping ``[token] flush_batch_delay``
+        seconds between batches so that a purge can safely run against a
+        live deployment.
+
+        :returns: number of tokens removed
+
+        """
+        raise exception.NotImplemented()
+
     def _get_default_expire_time(self):
         """Determine when a token should expire based on the config.
 
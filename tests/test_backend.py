@@ -71,6 +71,44 @@ class IdentityTests(object):
         self.assertDictEqual(tenant_ref, self.tenant_bar)
         self.assertDictEqual(metadata_ref, self.metadata_foobar)
 
+    def test_get_auth_bundle(self):
+        user_ref, tenant_ref, metadata_ref = (
+            self.identity_api.get_auth_bundle(
+                user_name=self.user_foo['name'],
+                tenant_name=self.tenant_bar['name'],
+                password=self.user_foo['password']))
+        self.user_foo.pop('password')
+        self.assertDictEqual(user_ref, self.user_foo)
+        self.assertDictEqual(tenant_ref, self.tenant_bar)
+        self.assertDictEqual(metadata_ref, self.metadata_foobar)
+
+        user_ref, tenant_ref, metadata_ref = (
+            self.identity_api.get_user_bundle(user_id=self.user_foo['id']))
+        self.assertDictEqual(user_ref, self.user_foo)
+        self.assertIsNone(tenant_ref)
+        self.assertEqual(metadata_ref, {})
+
+    def test_get_auth_bundle_failures(self):
+        self.assertRaises(AssertionError,
+                          self.identity_api.get_auth_bundle,
+                          user_id=self.user_foo['id'],
+                          password=uuid.uuid4().hex)
+        self.assertRaises(AssertionError,
+                          self.identity_api.get_auth_bundle,
+                          user_id=self.user_foo['id'],
+                          password=None)
+        self.assertRaises(AssertionError,
+                          self.identity_api.get_user_bundle,
+                          user_id=self.user_foo['id'],
+                          tenant_id=self.tenant_baz['id'])
+        self.assertRaises(exception.TenantNotFound,
+                          self.identity_api.get_user_bundle,
+                          user_id=self.user_foo['id'],
+                          tenant_id=uuid.uuid4().hex)
+        self.assertRaises(exception.UserNotFound,
+                          self.identity_api.get_user_bundle,
+                          user_name=uuid.uuid4().hex)
+
     def test_authenticate_role_return(self):
         self.identity_api.add_role_to_user_and_tenant(
             self.user_foo['id'], self.tenant_bar['id'], 'keystone_admin')
@@ -186,6 +224,19 @@ class IdentityTests(object):
                           self.identity_api.get_role,
                           role_id=uuid.uuid4().hex)
 
+    def test_get_roles(self):
+        role = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+        self.identity_api.create_role(role['id'], role)
+        role_ids = [role['id'], self.role_keystone_admin['id'], role['id']]
+        role_refs = self.identity_api.get_roles(role_ids)
+        self.assertEqual([x['id'] for x in role_refs], role_ids)
+        self.assertEqual(role_refs[1]['name'],
+                         self.role_keystone_admin['name'])
+        self.assertEqual(self.identity_api.get_roles([]), [])
+        self.assertRaises(exception.RoleNotFound,
+                          self.identity_api.get_roles,
+                          [role['id'], uuid.uuid4().hex])
+
     def test_create_duplicate_role_name_fails(self):
         role = {'id': 'fake1',
                 'name': 'fake1name'}
@@ -727,6 +778,18 @@ class TokenTests(object):
         self.token_api.create_token(token_id, data)
         return token_id
 
+    def test_get_tokens(self):
+        token_id1 = self.create_token_sample_data()
+        token_id2 = self.create_token_sample_data()
+        self.token_api.delete_token(token_id2)
+        token_id3 = self.create_token_sample_data()
+        token_refs = self.token_api.get_tokens(
+            [token_id1, token_id2, token_id3, uuid.uuid4().hex])
+        self.assertEqual(sorted(token_refs.keys()),
+                         sorted([token_id1, token_id3]))
+        self.assertEqual(token_refs[token_id1]['id'], token_id1)
+        self.assertEqual(self.token_api.get_tokens([]), {})
+
     def test_token_list(self):
         tokens = self.token_api.list_tokens('testuserid')
         self.assertEquals(len(tokens), 0)
@@ -831,6 +894,94 @@ class TokenTests(object):
         self.check_list_revoked_tokens([self.delete_token()
                                         for x in xrange(2)])
 
+    def test_list_revoked_tokens_since(self):
+        now = timeutils.utcnow().replace(microsecond=0)
+        timeutils.set_time_override(now)
+        try:
+            old_id = self.delete_token()
+            timeutils.advance_time_seconds(10)
+            new_id = self.delete_token()
+        finally:
+            timeutils.clear_time_override()
+
+        since = now + datetime.timedelta(seconds=5)
+        revoked = self.token_api.list_revoked_tokens(since=since)
+        self.assertEqual([x['id'] for x in revoked], [new_id])
+        self.assertEqual(revoked[0]['revoked_at'],
+                         now + datetime.timedelta(seconds=10))
+        revoked_ids = [x['id'] for x in self.token_api.list_revoked_tokens(
+            since=now + datetime.timedelta(seconds=10))]
+        self.assertEqual(revoked_ids, [new_id])
+        self.check_list_revoked_tokens([old_id, new_id])
+
+    def test_revoke_tokens(self):
+        tenant1 = uuid.uuid4().hex
+        tenant2 = uuid.uuid4().hex
+        token_id1 = self.create_token_sample_data(tenant_id=tenant1)
+        token_id2 = self.create_token_sample_data(tenant_id=tenant2)
+        token_id3 = self.create_token_sample_data()
+        generation = self.token_api.get_revocation_generation()
+
+        self.token_api.revoke_tokens('testuserid', tenant1)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id1)
+        self.assertEqual(sorted(self.token_api.list_tokens('testuserid')),
+                         sorted([token_id2, token_id3]))
+        self.check_list_revoked_tokens([token_id1])
+        self.assertNotEqual(self.token_api.get_revocation_generation(),
+                            generation)
+
+        self.token_api.revoke_tokens('testuserid')
+        self.assertEqual(self.token_api.list_tokens('testuserid'), [])
+        self.check_list_revoked_tokens([token_id1, token_id2, token_id3])
+
+    def test_revoke_tokens_without_tokens(self):
+        generation = self.token_api.get_revocation_generation()
+        self.token_api.revoke_tokens(uuid.uuid4().hex)
+        self.assertEqual(self.token_api.get_revocation_generation(),
+                         generation)
+
+    def test_revocation_generation(self):
+        generation = self.token_api.get_revocation_generation()
+        self.create_token_sample_data()
+        self.assertEqual(self.token_api.get_revocation_generation(),
+                         generation)
+        self.delete_token()
+        new_generation = self.token_api.get_revocation_generation()
+        self.assertNotEqual(new_generation, generation)
+        self.delete_token()
+        self.assertNotEqual(self.token_api.get_revocation_generation(),
+                            new_generation)
+
+    def test_flush_expired_tokens(self):
+        self.opt_in_group('token', flush_batch_size=1, flush_batch_delay=0)
+        now = timeutils.utcnow()
+        expired_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            expired_id,
+            {'id': expired_id, 'a': 'b',
+             'expires': now - datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        revoked_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            revoked_id,
+            {'id': revoked_id, 'a': 'b',
+             'expires': now + datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        self.token_api.delete_token(revoked_id)
+        live_id = self.create_token_sample_data()
+
+        timeutils.set_time_override(now + datetime.timedelta(minutes=2))
+        try:
+            self.assertTrue(self.token_api.flush_expired_tokens() > 0)
+            self.assertEqual(self.token_api.flush_expired_tokens(), 0)
+            revoked_ids = [x['id']
+                           for x in self.token_api.list_revoked_tokens()]
+            self.assertNotIn(revoked_id, revoked_ids)
+            self.token_api.get_token(live_id)
+        finally:
+            timeutils.clear_time_override()
+
 
 class CommonHelperTests(test.TestCase):
     def test_format_helper_raises_malformed_on_missing_key(self):
@@ -13,13 +13,18 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import datetime
 import uuid
 
 from keystone import catalog
 from keystone.catalog.backends import kvs as catalog_kvs
+from keystone.common import utils
 from keystone import exception
+from keystone import identity
 from keystone.identity.backends import kvs as identity_kvs
+from keystone.openstack.common import timeutils
 from keystone import test
+from keystone import token
 from keystone.token.backends import kvs as token_kvs
 
 import default_fixtures
@@ -33,11 +38,202 @@ class KvsIdentity(test.TestCase, test_backend.IdentityTests):
         self.load_fixtures(default_fixtures)
 
 
+class KvsRoleCache(test.TestCase):
+    def setUp(self):
+        super(KvsRoleCache, self).setUp()
+        self.opt_in_group('identity', role_cache_time=60)
+        self.stubs.Set(identity.core, '_ROLES', None)
+        self.identity_man = identity.Manager()
+        self.identity_man.driver = identity_kvs.Identity(db={})
+        self.role = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+        self.identity_man.create_role({}, self.role['id'], self.role)
+
+    def test_roles_are_served_from_cache(self):
+        self.assertEqual(self.identity_man.get_role({}, self.role['id']),
+                         self.role)
+        self.stubs.Set(self.identity_man.driver, 'list_roles', None)
+        self.stubs.Set(self.identity_man.driver, 'get_role', None)
+        role_ref = self.identity_man.get_role({}, self.role['id'])
+        role_ref['name'] = None
+        self.assertEqual(self.identity_man.get_roles({}, [self.role['id']]),
+                         [self.role])
+
+    def test_role_changes_invalidate_cache(self):
+        self.identity_man.get_role({}, self.role['id'])
+        self.identity_man.update_role({}, self.role['id'],
+                                      {'name': 'updated'})
+        self.assertEqual(
+            self.identity_man.get_role({}, self.role['id'])['name'],
+            'updated')
+        self.identity_man.delete_role({}, self.role['id'])
+        self.assertRaises(exception.RoleNotFound,
+                          self.identity_man.get_role, {}, self.role['id'])
+
+    def test_changes_by_other_processes(self):
+        self.identity_man.get_role({}, self.role['id'])
+        self.identity_man.driver.update_role(self.role['id'],
+                                             {'name': 'updated'})
+        self.assertEqual(
+            self.identity_man.get_role({}, self.role['id'])['name'],
+            self.role['name'])
+        timeutils.set_time_override(
+            timeutils.utcnow() + datetime.timedelta(seconds=61))
+        try:
+            self.assertEqual(
+                self.identity_man.get_role({}, self.role['id'])['name'],
+                'updated')
+        finally:
+            timeutils.clear_time_override()
+
+        role = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex}
+        self.identity_man.driver.create_role(role['id'], role)
+        self.assertEqual(self.identity_man.get_role({}, role['id']), role)
+
+
+class KvsPasswordCache(test.TestCase):
+    def setUp(self):
+        super(KvsPasswordCache, self).setUp()
+        self.opt_in_group('identity', password_cache_time=60)
+        self.stubs.Set(identity.core, '_PASSWORDS', None)
+        self.identity_man = identity.Manager()
+        self.identity_man.driver = identity_kvs.Identity(db={})
+        self.user = {'id': uuid.uuid4().hex, 'name': uuid.uuid4().hex,
+                     'password': uuid.uuid4().hex}
+        self.identity_man.driver.create_user(self.user['id'], self.user)
+
+        self.crypt_calls = []
+        check_password = utils.check_password
+
+        def counted_check_password(password, hashed):
+            self.crypt_calls.append(password)
+            return check_password(password, hashed)
+
+        self.stubs.Set(utils, 'check_password', counted_check_password)
+
+    def authenticate(self, password):
+        return self.identity_man.driver.authenticate(
+            user_id=self.user['id'], password=password)
+
+    def test_verified_password_skips_crypt(self):
+        self.authenticate(self.user['password'])
+        self.authenticate(self.user['password'])
+        self.assertEqual(len(self.crypt_calls), 1)
+        self.assertNotIn(self.user['password'],
+                         repr(identity.core._PASSWORDS.get(self.user['id'])))
+
+    def test_wrong_password_is_checked(self):
+        self.authenticate(self.user['password'])
+        self.assertRaises(AssertionError, self.authenticate, 'wrong')
+        self.assertRaises(AssertionError, self.authenticate, 'wrong')
+        self.assertEqual(len(self.crypt_calls), 3)
+
+    def test_password_change_invalidates_cache(self):
+        self.authenticate(self.user['password'])
+        self.identity_man.update_user({}, self.user['id'],
+                                      {'password': 'changed'})
+        self.assertIsNone(identity.core._PASSWORDS.get(self.user['id']))
+        self.assertRaises(AssertionError, self.authenticate,
+                          self.user['password'])
+        self.authenticate('changed')
+
+    def test_cached_password_expires(self):
+        self.authenticate(self.user['password'])
+        timeutils.set_time_override(
+            timeutils.utcnow() + datetime.timedelta(seconds=61))
+        try:
+            self.authenticate(self.user['password'])
+        finally:
+            timeutils.clear_time_override()
+        self.assertEqual(len(self.crypt_calls), 2)
+
+
 class KvsToken(test.TestCase, test_backend.TokenTests):
     def setUp(self):
         super(KvsToken, self).setUp()
         self.token_api = token_kvs.Token(db={})
 
+    def test_expired_tokens_are_evicted(self):
+        now = timeutils.utcnow()
+        token_ids = []
+        for minutes in (1, 2):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(
+                token_id,
+                {'id': token_id, 'user': {'id': 'testuserid'},
+                 'expires': now + datetime.timedelta(minutes=minutes)})
+            token_ids.append(token_id)
+        self.token_api.delete_token(token_ids[1])
+
+        timeutils.set_time_override(now + datetime.timedelta(minutes=5))
+        try:
+            token_id = self.create_token_sample_data()
+            self.assertNotIn('token-%s' % token_ids[0], self.token_api.db)
+            self.assertEqual(self.token_api.list_tokens('testuserid'),
+                             [token_id])
+            self.assertEqual(self.token_api.list_revoked_tokens(), [])
+            self.assertEqual(len(self.token_api.db['token-expiry-heap']), 1)
+        finally:
+            timeutils.clear_time_override()
+
+
+class KvsTokenCache(test.TestCase):
+    def setUp(self):
+        super(KvsTokenCache, self).setUp()
+        self.opt_in_group('token', cache_size=10)
+        self.stubs.Set(token.core, '_CACHE', None)
+        self.token_man = token.Manager()
+        self.token_man.driver = token_kvs.Token(db={})
+        self.token_id = uuid.uuid4().hex
+        self.token_man.create_token(
+            {}, self.token_id,
+            {'id': self.token_id, 'user': {'id': 'testuserid'},
+             'expires': timeutils.utcnow() + datetime.timedelta(minutes=5)})
+
+    def test_get_token_is_cached(self):
+        token_ref = self.token_man.get_token({}, self.token_id)
+        token_ref['user'] = None
+        self.assertEqual(self.token_man.get_token({}, self.token_id)['user'],
+                         {'id': 'testuserid'})
+        stats = self.token_man.get_cache_stats({})
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_cached_token_expires(self):
+        self.opt_in_group('token', cache_time=600)
+        self.token_man.get_token({}, self.token_id)
+        timeutils.set_time_override(
+            timeutils.utcnow() + datetime.timedelta(minutes=6))
+        try:
+            self.assertRaises(exception.TokenNotFound,
+                              self.token_man.get_token, {}, self.token_id)
+        finally:
+            timeutils.clear_time_override()
+
+    def test_delete_token_evicts_cached_token(self):
+        self.token_man.get_token({}, self.token_id)
+        self.token_man.delete_token({}, self.token_id)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_man.get_token, {}, self.token_id)
+
+    def test_revoke_tokens_evicts_cached_tokens(self):
+        self.token_man.get_token({}, self.token_id)
+        self.token_man.revoke_tokens({}, 'testuserid')
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_man.get_token, {}, self.token_id)
+
+    def test_get_tokens_is_cached(self):
+        self.token_man.get_token({}, self.token_id)
+        missing_id = uuid.uuid4().hex
+        token_refs = self.token_man.get_tokens({}, [self.token_id,
+                                                    missing_id])
+        self.assertEqual(token_refs.keys(), [self.token_id])
+        stats = self.token_man.get_cache_stats({})
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_cache_disabled(self):
+        self.opt_in_group('token', cache_size=0)
+        self.token_man.get_token({}, self.token_id)
+        self.assertEqual(self.token_man.get_cache_stats({}), {})
+
 
 class KvsCatalog(test.TestCase, test_backend.CatalogTests):
     def setUp(self):
@@ -84,3 +280,85 @@ class KvsCatalog(test.TestCase, test_backend.CatalogTests):
         self.assertRaises(exception.NotImplemented,
                           self.catalog_api.delete_endpoint,
                           uuid.uuid4().hex)
+
+
+class KvsRevocationFilter(test.TestCase):
+    def setUp(self):
+        super(KvsRevocationFilter, self).setUp()
+        self.token_man = token.Manager()
+        self.token_man.driver = token_kvs.Token(db={})
+
+    def _create_token(self):
+        token_id = uuid.uuid4().hex
+        self.token_man.create_token(
+            {}, token_id,
+            {'id': token_id, 'user': {'id': 'testuserid'},
+             'expires': timeutils.utcnow() + datetime.timedelta(minutes=5)})
+        return token_id
+
+    def test_deleted_token_is_revoked(self):
+        token_id = self._create_token()
+        live_id = self._create_token()
+        self.assertFalse(self.token_man.is_revoked({}, token_id))
+        self.token_man.delete_token({}, token_id)
+        self.assertTrue(self.token_man.is_revoked({}, token_id))
+        self.assertFalse(self.token_man.is_revoked({}, live_id))
+
+    def test_filter_is_updated_on_new_revocations(self):
+        self.token_man.delete_token({}, self._create_token())
+        generation, bloom = self.token_man.get_revocation_filter({})
+        self.assertIs(self.token_man.get_revocation_filter({})[1], bloom)
+
+        cursors = []
+        list_revoked_tokens = self.token_man.driver.list_revoked_tokens
+
+        def fake_list_revoked_tokens(since=None):
+            cursors.append(since)
+            return list_revoked_tokens(since=since)
+        self.stubs.Set(self.token_man.driver, 'list_revoked_tokens',
+                       fake_list_revoked_tokens)
+        # revoked by a process whose clock is a minute behind
+        token_id = self._create_token()
+        timeutils.set_time_override(
+            timeutils.utcnow() - datetime.timedelta(minutes=1))
+        try:
+            self.token_man.revoke_tokens({}, 'testuserid')
+        finally:
+            timeutils.clear_time_override()
+        new_generation, new_bloom = self.token_man.get_revocation_filter({})
+        self.assertNotEqual(new_generation, generation)
+        self.assertIs(new_bloom, bloom)
+        self.assertEqual(bloom.count, 2)
+        self.assertIn(token_id, bloom)
+        self.assertTrue(self.token_man.is_revoked({}, token_id))
+        self.assertEqual(len(cursors), 1)
+        self.assertIsNotNone(cursors[0])
+
+    def test_full_filter_is_rebuilt(self):
+        self.opt_in_group('token', revocation_filter_capacity=1)
+        # sized for twice as many tokens as were revoked
+        self.token_man.delete_token({}, self._create_token())
+        generation, bloom = self.token_man.get_revocation_filter({})
+        self.token_man.delete_token({}, self._create_token())
+        self.assertIs(self.token_man.get_revocation_filter({})[1], bloom)
+        self.assertTrue(bloom.is_full())
+
+        token_id = self._create_token()
+        self.token_man.delete_token({}, token_id)
+        new_generation, new_bloom = self.token_man.get_revocation_filter({})
+        self.assertIsNot(new_bloom, bloom)
+        self.assertEqual(new_bloom.count, 3)
+        self.assertIn(token_id, new_bloom)
+
+    def test_hits_are_confirmed_without_listing_revocations(self):
+        token_id = self._create_token()
+        self.token_man.delete_token({}, token_id)
+        self.token_man.get_revocation_filter({})
+        self.stubs.Set(self.token_man.driver, 'list_revoked_tokens', None)
+        self.assertTrue(self.token_man.is_revoked({}, token_id))
+
+    def test_false_positive_is_not_revoked(self):
+        token_id = self._create_token()
+        generation, bloom = self.token_man.get_revocation_filter({})
+        bloom.add(token_id)
+        self.assertFalse(self.token_man.is_revoked({}, token_id))
@@ -14,11 +14,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import uuid
 
 import memcache
 
+from keystone.common import cms
 from keystone.common import utils
+from keystone import exception
 from keystone.openstack.common import timeutils
 from keystone import test
 from keystone.token.backends import memcache as token_memcache
@@ -32,22 +35,34 @@ class MemcacheClient(object):
     def __init__(self, *args, **kwargs):
         """Ignores the passed in args."""
         self.cache = {}
+        self.cas_ids = {}
+        self.versions = {}
 
-    def add(self, key, value):
+    def add(self, key, value, time=0):
         if self.get(key):
             return False
-        return self.set(key, value)
+        return self.set(key, value, time)
 
     def append(self, key, value):
         existing_value = self.get(key)
         if existing_value:
-            self.set(key, existing_value + value)
+            self.set(key, existing_value + value, self.cache[key][1])
             return True
         return False
 
+    def incr(self, key, delta=1):
+        value = self.get(key)
+        if value is None:
+            return None
+        value = int(value) + delta
+        self.set(key, value, self.cache[key][1])
+        return value
+
     def check_key(self, key):
         if not isinstance(key, str):
             raise memcache.Client.MemcachedStringEncodingError()
+        if len(key) > memcache.SERVER_MAX_KEY_LENGTH:
+            raise memcache.Client.MemcachedKeyLengthError()
 
     def get(self, key):
         """Retrieves the value for a key or None."""
@@ -57,12 +72,39 @@ class MemcacheClient(object):
         if obj and (obj[1] == 0 or obj[1] > now):
             return obj[0]
 
+    def get_multi(self, keys):
+        """Retrieves the values for several keys, omitting missing ones."""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def gets(self, key):
+        """Retrieves the value for a key and remembers its CAS id."""
+        value = self.get(key)
+        if value is not None:
+            self.cas_ids[key] = self.versions.get(key)
+        return value
+
     def set(self, key, value, time=0):
         """Sets the value for a key."""
         self.check_key(key)
         self.cache[key] = (value, time)
+        self.versions[key] = self.versions.get(key, 0) + 1
         return True
 
+    def cas(self, key, value, time=0):
+        """Sets the value for a key unless it changed since gets()."""
+        self.check_key(key)
+        if key not in self.cas_ids:
+            return self.set(key, value, time)
+        cas_id = self.cas_ids.pop(key)
+        if self.versions.get(key) != cas_id:
+            return False
+        return self.set(key, value, time)
+
     def delete(self, key):
         self.check_key(key)
         try:
@@ -71,6 +113,11 @@ class MemcacheClient(object):
             #NOTE(bcwaldon): python-memcached always returns the same value
             pass
 
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
 
 class MemcacheToken(test.TestCase, test_backend.TokenTests):
     def setUp(self):
@@ -78,6 +125,11 @@ class MemcacheToken(test.TestCase, test_backend.TokenTests):
         fake_client = MemcacheClient()
         self.token_api = token_memcache.Token(client=fake_client)
 
+    def _get_user_token_ids(self, user_id):
+        user_key = self.token_api._prefix_user_id(user_id)
+        return [token_id for token_id, _expires
+                in self.token_api._get_user_list(user_key)]
+
     def test_create_unicode_token_id(self):
         token_id = unicode(uuid.uuid4().hex)
         data = {'id': token_id, 'a': 'b',
@@ -96,3 +148,152 @@ class MemcacheToken(test.TestCase, test_backend.TokenTests):
     def test_list_tokens_unicode_user_id(self):
         user_id = unicode(uuid.uuid4().hex)
         self.token_api.list_tokens(user_id)
+
+    def test_user_token_list_is_compacted(self):
+        user_id = uuid.uuid4().hex
+        expires = timeutils.utcnow() + datetime.timedelta(minutes=1)
+        expiring_ids = []
+        for x in xrange(3):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(
+                token_id,
+                {'id': token_id, 'expires': expires, 'user': {'id': user_id}})
+            expiring_ids.append(token_id)
+        user_key = self.token_api._prefix_user_id(user_id)
+        self.assertEqual(len(self.token_api._get_user_list(user_key)), 3)
+
+        timeutils.set_time_override(expires + datetime.timedelta(minutes=1))
+        try:
+            # compacting the index must not fetch the indexed tokens
+            self.stubs.Set(self.token_api, '_get_live_tokens', None)
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(
+                token_id, {'id': token_id, 'user': {'id': user_id}})
+            self.stubs.UnsetAll()
+            self.assertEqual(self._get_user_token_ids(user_id), [token_id])
+            self.assertEqual(self.token_api.list_tokens(user_id), [token_id])
+        finally:
+            timeutils.clear_time_override()
+
+    def test_list_tokens_compacts_user_token_list(self):
+        user_id = uuid.uuid4().hex
+        token_ids = []
+        for x in xrange(3):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(
+                token_id, {'id': token_id, 'user': {'id': user_id}})
+            token_ids.append(token_id)
+        self.token_api.delete_token(token_ids[0])
+        self.assertEqual(self.token_api.list_tokens(user_id), token_ids[1:])
+        self.assertEqual(self._get_user_token_ids(user_id), token_ids[1:])
+
+    def test_legacy_user_token_list(self):
+        user_id = uuid.uuid4().hex
+        expires = timeutils.utcnow() + datetime.timedelta(minutes=1)
+        token_ids = []
+        for x in xrange(2):
+            token_id = uuid.uuid4().hex
+            self.token_api.create_token(
+                token_id,
+                {'id': token_id, 'expires': expires, 'user': {'id': 'other'}})
+            token_ids.append(token_id)
+        self.token_api.delete_token(token_ids[0])
+        user_key = self.token_api._prefix_user_id(user_id)
+        self.token_api.client.set(
+            user_key, ','.join('"%s"' % token_id for token_id in token_ids))
+
+        self.assertEqual(self.token_api._get_user_list(user_key),
+                         [(token_ids[1], utils.unixtime(expires))])
+        token_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            token_id, {'id': token_id, 'user': {'id': user_id}})
+        self.assertEqual(self._get_user_token_ids(user_id),
+                         [token_ids[1], token_id])
+
+    def test_legacy_user_token_list_with_pki_tokens(self):
+        user_id = uuid.uuid4().hex
+        expires = timeutils.utcnow() + datetime.timedelta(minutes=1)
+        token_id = 'MII' + 'x' * 1000
+        self.token_api.create_token(
+            token_id,
+            {'id': token_id, 'expires': expires, 'user': {'id': 'other'}})
+        user_key = self.token_api._prefix_user_id(user_id)
+        self.token_api.client.set(user_key, '"%s"' % token_id)
+
+        self.assertEqual(self.token_api._get_user_list(user_key),
+                         [(cms.cms_hash_token(token_id),
+                           utils.unixtime(expires))])
+
+    def test_revocation_list_is_bucketed_by_expiry(self):
+        now = timeutils.utcnow()
+        token_id = uuid.uuid4().hex
+        expires = now + datetime.timedelta(minutes=1)
+        self.token_api.create_token(
+            token_id, {'id': token_id, 'expires': expires,
+                       'user': {'id': 'testuserid'}})
+        self.token_api.delete_token(token_id)
+
+        bucket = self.token_api._revocation_bucket(expires)
+        key = self.token_api._prefix_revocation_bucket(bucket)
+        self.assertIn(token_id, self.token_api.client.get(key))
+        self.assertIsNone(
+            self.token_api.client.get(self.token_api.revocation_key))
+        revoked = self.token_api.list_revoked_tokens()
+        self.assertEqual([(x['id'], x['expires']) for x in revoked],
+                         [(token_id, expires)])
+
+        timeutils.set_time_override(expires + datetime.timedelta(hours=1))
+        try:
+            self.assertIsNone(self.token_api.client.get(key))
+            self.assertEqual(self.token_api.list_revoked_tokens(), [])
+        finally:
+            timeutils.clear_time_override()
+
+    def test_flush_expired_tokens(self):
+        """Expired tokens and bucketed revocations expire in memcached."""
+        now = timeutils.utcnow()
+        expired_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            expired_id,
+            {'id': expired_id, 'a': 'b',
+             'expires': now - datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        revoked_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            revoked_id,
+            {'id': revoked_id, 'a': 'b',
+             'expires': now + datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        self.token_api.delete_token(revoked_id)
+        live_id = self.create_token_sample_data()
+
+        timeutils.set_time_override(now + datetime.timedelta(minutes=2))
+        try:
+            self.assertEqual(self.token_api.flush_expired_tokens(), 0)
+            revoked_ids = [x['id']
+                           for x in self.token_api.list_revoked_tokens()]
+            self.assertNotIn(revoked_id, revoked_ids)
+            self.assertRaises(exception.TokenNotFound,
+                              self.token_api.get_token, expired_id)
+            self.token_api.get_token(live_id)
+        finally:
+            timeutils.clear_time_override()
+
+    def test_flush_expired_tokens_prunes_unbucketed_revocations(self):
+        now = timeutils.utcnow()
+        token_id = uuid.uuid4().hex
+        expires = now + datetime.timedelta(days=30)
+        self.token_api.create_token(
+            token_id, {'id': token_id, 'expires': expires,
+                       'user': {'id': 'testuserid'}})
+        self.token_api.delete_token(token_id)
+        self.assertIn(
+            token_id,
+            self.token_api.client.get(self.token_api.revocation_key))
+
+        timeutils.set_time_override(expires + datetime.timedelta(minutes=1))
+        try:
+            self.assertEqual(self.token_api.flush_expired_tokens(), 1)
+            self.assertEqual(self.token_api.list_revoked_tokens(), [])
+        finally:
+            timeutils.clear_time_override()
@@ -14,15 +14,24 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
+import os
+import time
 import uuid
 
+import nose
+
 from keystone.common import sql
 from keystone import catalog
+from keystone import cli
 from keystone import config
 from keystone import exception
 from keystone import identity
 from keystone import test
+from keystone.openstack.common import timeutils
 from keystone import token
+from keystone.token.backends import partitioned as token_partitioned
+from keystone.token.backends import sql as token_sql
 
 import default_fixtures
 import test_backend
@@ -207,7 +216,252 @@ class SqlIdentity(SqlTests, test_backend.IdentityTests):
 
 
 class SqlToken(SqlTests, test_backend.TokenTests):
-    pass
+    def test_token_flush_command(self):
+        now = timeutils.utcnow()
+        expired_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            expired_id,
+            {'id': expired_id, 'a': 'b',
+             'expires': now - datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        live_id = self.create_token_sample_data()
+
+        cli.main(argv=['keystone-manage', 'token_flush'],
+                 config_files=[test.etcdir('keystone.conf.sample'),
+                               test.testsdir('test_overrides.conf'),
+                               test.testsdir('backend_sql.conf')])
+        session = self.token_api.get_session()
+        self.assertEqual([token_ref.id for token_ref in
+                          session.query(token_sql.TokenModel)],
+                         [live_id])
+
+
+class SqlWriteBehindToken(SqlTests, test_backend.TokenTests):
+    def setUp(self):
+        if os.getenv('STANDARD_THREADS'):
+            raise nose.exc.SkipTest('in-memory sqlite can not be shared by'
+                                    ' threads')
+        super(SqlWriteBehindToken, self).setUp()
+        # keep the background writer out of the way of the tests
+        self.opt_in_group('token', write_behind=True,
+                          write_behind_interval=3600)
+        self.stubs.Set(token_sql, '_BUFFER', None)
+
+    def tearDown(self):
+        if token_sql._BUFFER is not None:
+            token_sql._BUFFER.close()
+        super(SqlWriteBehindToken, self).tearDown()
+
+    def _count_rows(self):
+        session = self.token_api.get_session()
+        return session.query(token_sql.TokenModel).count()
+
+    def test_tokens_are_buffered(self):
+        token_id = self.create_token_sample_data()
+        self.assertEqual(self._count_rows(), 0)
+        self.assertEqual(self.token_api.get_token(token_id)['id'], token_id)
+
+        self.assertEqual(self.token_api.list_tokens('testuserid'),
+                         [token_id])
+        self.assertEqual(self._count_rows(), 1)
+        self.assertEqual(len(token_sql._BUFFER), 0)
+
+    def test_tokens_are_written_in_batches(self):
+        self.opt_in_group('token', write_behind_batch_size=2)
+        writes = []
+        write_tokens = self.token_api._write_tokens
+
+        def fake_write_tokens(rows):
+            writes.append(len(rows))
+            write_tokens(rows)
+        self.stubs.Set(self.token_api, '_write_tokens', fake_write_tokens)
+        for i in range(5):
+            self.create_token_sample_data()
+        token_sql._BUFFER.flush()
+        self.assertEqual(writes, [2, 2, 1])
+        self.assertEqual(self._count_rows(), 5)
+
+    def test_tokens_are_written_in_background(self):
+        self.opt_in_group('token', write_behind_interval=0.01)
+        self.create_token_sample_data()
+        for i in range(100):
+            if not len(token_sql._BUFFER):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self._count_rows(), 1)
+
+    def test_tokens_which_cannot_be_written_are_dropped(self):
+        self.opt_in_group('token', write_behind_batch_size=3)
+        token_ids = [self.create_token_sample_data() for i in range(2)]
+        token_sql._BUFFER.flush()
+        # the token of the second row of the next batch is already written
+        token_ids.append(self.create_token_sample_data())
+        token_sql._BUFFER.add(
+            token_ids[0], {'id': token_ids[0]},
+            dict(id=token_ids[0], expires=None, extra={}, valid=True,
+                 user_id='testuserid', tenant_id=None, revoked_at=None))
+        token_ids.append(self.create_token_sample_data())
+
+        token_sql._BUFFER.flush()
+        self.assertEqual(len(token_sql._BUFFER), 0)
+        self.assertEqual(self._count_rows(), 4)
+        self.assertEqual(sorted(self.token_api.list_tokens('testuserid')),
+                         sorted(token_ids))
+
+    def test_tokens_are_kept_while_the_database_is_unavailable(self):
+        token_id = self.create_token_sample_data()
+        buffer = token_sql._BUFFER
+        write = buffer._write
+
+        def write_tokens(rows):
+            raise sql.OperationalError('INSERT', {},
+                                       Exception('database is locked'))
+        buffer._write = write_tokens
+        self.assertRaises(sql.OperationalError, buffer.flush)
+        self.assertEqual(len(buffer), 1)
+        buffer._write = write
+        buffer.flush()
+        self.assertEqual(self.token_api.get_token(token_id)['id'], token_id)
+        self.assertEqual(self._count_rows(), 1)
+
+    def test_full_buffer_is_written_by_issuer(self):
+        self.opt_in_group('token', write_behind_queue_size=3)
+        for i in range(4):
+            self.create_token_sample_data()
+        self.assertEqual(len(token_sql._BUFFER), 1)
+        self.assertEqual(self._count_rows(), 3)
+
+    def test_full_buffer_refuses_tokens_while_the_database_is_unavailable(
+            self):
+        self.opt_in_group('token', write_behind_queue_size=2)
+        for i in range(2):
+            self.create_token_sample_data()
+        buffer = token_sql._BUFFER
+
+        def write_tokens(rows):
+            raise sql.OperationalError('INSERT', {},
+                                       Exception('database is locked'))
+        buffer._write = write_tokens
+        token_id = uuid.uuid4().hex
+        self.assertRaises(sql.OperationalError,
+                          self.token_api.create_token,
+                          token_id,
+                          {'id': token_id, 'a': 'b',
+                           'user': {'id': 'testuserid'}})
+        self.assertEqual(len(buffer), 2)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+
+class SqlPartitionedToken(SqlTests, test_backend.TokenTests):
+    def setUp(self):
+        super(SqlPartitionedToken, self).setUp()
+        self.token_api = token_partitioned.Token()
+
+    def test_flush_expired_tokens(self):
+        """Expired tokens are only dropped a period after theirs ends."""
+        now = timeutils.utcnow()
+        expired_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            expired_id,
+            {'id': expired_id, 'a': 'b',
+             'expires': now - datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        revoked_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            revoked_id,
+            {'id': revoked_id, 'a': 'b',
+             'expires': now + datetime.timedelta(minutes=1),
+             'user': {'id': 'testuserid'}})
+        self.token_api.delete_token(revoked_id)
+        live_id = self.create_token_sample_data()
+
+        later = now + datetime.timedelta(
+            seconds=3 * CONF.token.partition_seconds)
+        timeutils.set_time_override(later)
+        try:
+            self.token_api.flush_expired_tokens()
+            revoked_ids = [x['id']
+                           for x in self.token_api.list_revoked_tokens()]
+            self.assertNotIn(revoked_id, revoked_ids)
+            self.token_api.get_token(live_id)
+        finally:
+            timeutils.clear_time_override()
+
+    def test_expired_partitions_are_dropped(self):
+        now = timeutils.utcnow()
+        token_id = uuid.uuid4().hex
+        self.token_api.create_token(
+            token_id,
+            {'id': token_id, 'user': {'id': 'testuserid'},
+             'expires': now + datetime.timedelta(minutes=1)})
+        live_id = self.create_token_sample_data()
+
+        engine = self.token_api.get_engine()
+        partitions = [name for name in engine.table_names()
+                      if name.startswith(token_partitioned.PARTITION_PREFIX)]
+        timeutils.set_time_override(now + datetime.timedelta(hours=3))
+        try:
+            # tokens of dropped partitions are not counted
+            self.assertEqual(self.token_api.flush_expired_tokens(), 0)
+            self.token_api.get_token(live_id)
+        finally:
+            timeutils.clear_time_override()
+        remaining = engine.table_names()
+        self.assertTrue([name for name in partitions
+                         if name not in remaining])
+        self.assertIn(token_partitioned.OVERFLOW_PARTITION, remaining)
+
+    def test_partition_seconds_are_whole_minutes(self):
+        self.opt_in_group('token', partition_seconds=90)
+        self.assertRaises(ValueError, token_partitioned.Token)
+        self.opt_in_group('token', partition_seconds=30)
+        self.assertRaises(ValueError, token_partitioned.Token)
+
+    def test_upcoming_partitions_are_created(self):
+        now = timeutils.utcnow()
+        last = self.token_api._period(
+            now + datetime.timedelta(seconds=CONF.token.expiration))
+        next_partition = self.token_api._partition_name(last + 1)
+        engine = self.token_api.get_engine()
+        self.assertNotIn(next_partition, engine.table_names())
+        self.token_api.flush_expired_tokens()
+        self.assertIn(next_partition, engine.table_names())
+
+    def test_lookups_do_not_create_partitions(self):
+        def create_partition(name):
+            raise AssertionError('created partition %s' % name)
+        self.stubs.Set(self.token_api, '_partition', create_partition)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, uuid.uuid4().hex)
+        self.assertEqual(self.token_api.list_tokens('testuserid'), [])
+        self.assertEqual(self.token_api.list_revoked_tokens(), [])
+        self.token_api.revoke_tokens('testuserid')
+        self.stubs.UnsetAll()
+
+        # a partition created by another process is found
+        token_id = self.create_token_sample_data()
+        self.stubs.Set(self.token_api, '_partition', create_partition)
+        other = token_partitioned.Token()
+        self.stubs.Set(other, '_partition', create_partition)
+        self.assertEqual(other.get_token(token_id)['id'], token_id)
+        other.delete_token(token_id)
+        self.assertRaises(exception.TokenNotFound,
+                          self.token_api.get_token, token_id)
+
+    def test_partition_created_concurrently(self):
+        name = self.token_api._partition_name(
+            self.token_api._period(timeutils.utcnow()))
+        token_partitioned.Token()._partition(name)
+
+        # another process creates the table between the check and the
+        # creation of this one
+        table = self.token_api._table(name)
+        create = table.create
+        self.stubs.Set(table, 'create',
+                       lambda bind, checkfirst: create(bind=bind,
+                                                       checkfirst=False))
+        self.assertEqual(self.token_api._partition(name), table)
 
 
 class SqlCatalog(SqlTests, test_backend.CatalogTests):
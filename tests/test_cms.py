@@ -0,0 +1,224 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import subprocess
+import threading
+
+import nose
+
+from keystone.common import cms
+from keystone.common import workers
+from keystone import test
+
+
+CERTDIR = test.rootdir('examples/pki/certs')
+SIGNING_CERT = os.path.join(CERTDIR, 'signing_cert.pem')
+SIGNING_KEY = os.path.join(test.rootdir('examples/pki/private'),
+                           'signing_key.pem')
+CA = os.path.join(CERTDIR, 'cacert.pem')
+TEXT = json.dumps({'access': {'token': {'id': 'placeholder'}}})
+
+
+def digest_algorithms(signed):
+    """Returns the digest algorithms named in a PEM CMS document."""
+    process = subprocess.Popen(['openssl', 'cms', '-cmsout', '-print',
+                                '-inform', 'PEM'],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, err = process.communicate(signed)
+    lines = [line.strip() for line in output.splitlines()]
+    return [line.split()[1]
+            for previous, line in zip(lines, lines[1:])
+            if previous.startswith('digestAlgorithm') and
+            line.startswith('algorithm:')]
+
+
+class CmsEngineTests(object):
+    def test_sign_and_verify(self):
+        signed = self.engine.sign(TEXT, SIGNING_CERT, SIGNING_KEY)
+        self.assertTrue(signed.startswith('-----BEGIN CMS-----\n'))
+        self.assertEqual(self.engine.verify(signed, SIGNING_CERT, CA), TEXT)
+
+    def test_signing_digest(self):
+        signed = self.engine.sign(TEXT, SIGNING_CERT, SIGNING_KEY)
+        self.assertEqual(set(digest_algorithms(signed)),
+                         set([cms.SIGNING_DIGEST]))
+
+    def test_verify_token(self):
+        token = cms.cms_to_token(self.engine.sign(TEXT, SIGNING_CERT,
+                                                  SIGNING_KEY))
+        self.assertTrue(cms.is_ans1_token(token))
+        self.assertEqual(
+            self.engine.verify(cms.token_to_cms(token), SIGNING_CERT, CA),
+            TEXT)
+
+    def test_verify_tampered_document(self):
+        token = cms.cms_to_token(self.engine.sign(TEXT, SIGNING_CERT,
+                                                  SIGNING_KEY))
+        token = token[:-20] + ('A' if token[-20] != 'A' else 'B') + token[-19:]
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.engine.verify, cms.token_to_cms(token),
+                          SIGNING_CERT, CA)
+
+
+class SubprocessEngine(test.TestCase, CmsEngineTests):
+    def setUp(self):
+        super(SubprocessEngine, self).setUp()
+        self.engine = cms.SubprocessEngine()
+
+
+class PoolEngine(test.TestCase, CmsEngineTests):
+    def setUp(self):
+        super(PoolEngine, self).setUp()
+        try:
+            self.engine = cms.PoolEngine(pool_size=1, batch_size=4)
+        except ImportError:
+            raise nose.exc.SkipTest('M2Crypto is not installed')
+
+    def tearDown(self):
+        self.engine.close()
+        super(PoolEngine, self).tearDown()
+
+    def test_concurrent_jobs_are_batched(self):
+        signed = []
+        threads = [threading.Thread(
+            target=lambda: signed.append(
+                self.engine.sign(TEXT, SIGNING_CERT, SIGNING_KEY)))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(signed), 8)
+        for text in signed:
+            self.assertEqual(self.engine.verify(text, SIGNING_CERT, CA),
+                             TEXT)
+        stats = self.engine.stats()
+        self.assertEqual(stats['jobs'], 16)
+        self.assertTrue(stats['batches'] < 16)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_failure_to_spawn_a_worker(self):
+        def spawn():
+            raise OSError('Cannot allocate memory')
+        self.stubs.Set(self.engine._pool, '_spawn', spawn)
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.engine.sign, TEXT, SIGNING_CERT, SIGNING_KEY)
+        self.stubs.UnsetAll()
+        self.test_sign_and_verify()
+
+    def test_unanswered_job_times_out(self):
+        self.engine._pool.timeout = 0.1
+        pipes = workers._subprocess()
+        self.stubs.Set(self.engine._pool, '_spawn',
+                       lambda: pipes.Popen(['sleep', '1'],
+                                           stdin=pipes.PIPE,
+                                           stdout=pipes.PIPE))
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.engine.sign, TEXT, SIGNING_CERT, SIGNING_KEY)
+
+    def test_close(self):
+        self.test_sign_and_verify()
+        self.engine.close()
+        for worker in self.engine._pool._threads:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+
+
+class M2CryptoEngine(test.TestCase, CmsEngineTests):
+    def setUp(self):
+        super(M2CryptoEngine, self).setUp()
+        try:
+            self.engine = cms.M2CryptoEngine()
+        except ImportError:
+            raise nose.exc.SkipTest('M2Crypto is not installed')
+
+    def test_output_matches_openssl(self):
+        self.assertEqual(
+            self.engine.sign(TEXT, SIGNING_CERT, SIGNING_KEY),
+            cms.SubprocessEngine().sign(TEXT, SIGNING_CERT, SIGNING_KEY))
+
+
+class PkizTokens(test.TestCase):
+    def test_sign_and_verify(self):
+        token = cms.pkiz_sign(TEXT, SIGNING_CERT, SIGNING_KEY)
+        self.assertTrue(cms.is_pkiz_token(token))
+        self.assertFalse(cms.is_ans1_token(token))
+        self.assertEqual(
+            cms.cms_verify(cms.pkiz_to_cms(token), SIGNING_CERT, CA), TEXT)
+
+    def test_hash_token(self):
+        token = cms.pkiz_sign(TEXT, SIGNING_CERT, SIGNING_KEY)
+        self.assertNotEqual(cms.cms_hash_token(token), token)
+
+    def test_compressed_token_is_smaller(self):
+        text = json.dumps({'access': {'serviceCatalog': [
+            {'type': 'service%d' % i,
+             'endpoints': [{'publicURL': 'http://public.example.com:%d/v2'
+                                         % i}] * 3}
+            for i in range(20)]}})
+        pki = cms.cms_sign_token(text, SIGNING_CERT, SIGNING_KEY)
+        pkiz = cms.pkiz_sign(text, SIGNING_CERT, SIGNING_KEY)
+        self.assertTrue(len(pkiz) * 3 < len(pki))
+
+    def test_invalid_token(self):
+        self.assertRaises(ValueError, cms.pkiz_to_cms, 'PKIZ_not-a-token')
+
+
+class EngineSelection(test.TestCase):
+    def setUp(self):
+        super(EngineSelection, self).setUp()
+        self.stubs.Set(cms, '_engine', None)
+
+    def test_default_engine(self):
+        self.assertTrue(isinstance(cms.get_engine(), cms.SubprocessEngine))
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, cms.set_engine, 'unknown')
+
+    def test_fallback_to_subprocess(self):
+        class BrokenEngine(object):
+            def __init__(self):
+                raise ImportError('No module named M2Crypto')
+        self.stubs.Set(cms, 'ENGINES', {'m2crypto': BrokenEngine})
+        cms.set_engine('m2crypto')
+        self.assertTrue(isinstance(cms.get_engine(), cms.SubprocessEngine))
+
+    def test_replaced_engine_is_closed(self):
+        closed = []
+
+        class Engine(object):
+            def __init__(self, **options):
+                pass
+
+            def close(self):
+                closed.append(self)
+
+        class OtherEngine(Engine):
+            pass
+
+        self.stubs.Set(cms, 'ENGINES', {'engine': Engine,
+                                        'other': OtherEngine})
+        cms.set_engine('engine')
+        engine = cms.get_engine()
+        cms.set_engine('engine')
+        self.assertEqual(closed, [])
+        cms.set_engine('other')
+        self.assertEqual(closed, [engine])
@@ -12,10 +12,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import datetime
+import json
 import uuid
 
 import default_fixtures
 
+from keystone.common import cms
+from keystone.common import sql
+from keystone.common import utils
+from keystone.common import wsgi
 from keystone import exception
 from keystone import identity
 from keystone import service
@@ -216,6 +223,18 @@ class AuthWithPasswordCredentials(TokenControllerTest):
             self.api.authenticate,
             {}, body_dict)
 
+    def test_auth_null_password(self):
+        """Verify exception is raised if null password"""
+        for body_dict in ({'passwordCredentials': {'username': 'FOO',
+                                                   'password': None}},
+                          {'passwordCredentials': {'username': 'FOO',
+                                                   'password': None},
+                           'tenantName': 'BAR'}):
+            self.assertRaises(
+                exception.ValidationError,
+                self.api.authenticate,
+                {}, body_dict)
+
     def test_authenticate_blank_password_credentials(self):
         """Verify sending empty json dict as passwordCredentials raises the
         right exception."""
@@ -296,3 +315,432 @@ class AuthWithRemoteUser(TokenControllerTest):
             self.api.authenticate,
             {'REMOTE_USER': uuid.uuid4().hex},
             body_dict)
+
+
+class RevocationListTest(TokenControllerTest):
+    def setUp(self):
+        super(RevocationListTest, self).setUp()
+        self.opt_in_group('signing', token_format='UUID')
+        self.signed = []
+
+        def fake_sign_text(text, signing_cert_file_name,
+                           signing_key_file_name):
+            self.signed.append(text)
+            return text
+        self.stubs.Set(cms, 'cms_sign_text', fake_sign_text)
+
+    def _revoke_token(self):
+        body_dict = _build_user_auth(username='FOO', password='foo2')
+        token_ref = self.api.authenticate({}, body_dict)
+        self.api.delete_token({'is_admin': True},
+                              token_ref['access']['token']['id'])
+
+    def test_revocation_list_is_cached(self):
+        context = {'is_admin': True}
+        response = self.api.revocation_list(context)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['Cache-Control'],
+                         'private, max-age=0')
+        etag = response.headers['ETag']
+        self.assertEqual(len(self.signed), 1)
+
+        response = self.api.revocation_list(context)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.signed), 1)
+
+        self._revoke_token()
+        response = self.api.revocation_list(context)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.signed), 2)
+
+    def test_revocation_list_not_modified(self):
+        response = self.api.revocation_list({'is_admin': True})
+        etag = response.headers['ETag']
+
+        context = {'is_admin': True, 'headers': {'If-None-Match': etag}}
+        response = self.api.revocation_list(context)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, '')
+
+        self._revoke_token()
+        response = self.api.revocation_list(context)
+        self.assertEqual(response.status_int, 200)
+
+    def _revocation_list(self, since=None):
+        context = {'is_admin': True, 'query_string': {}}
+        if since is not None:
+            context['query_string']['since'] = since
+        response = self.api.revocation_list(context)
+        return json.loads(json.loads(response.body)['signed'])
+
+    def test_revocation_list_since(self):
+        self.opt_in_group('token', revocation_list_overlap=60)
+        start = timeutils.utcnow().replace(microsecond=0)
+        timeutils.set_time_override(start)
+        try:
+            self._revoke_token()
+            timeutils.advance_time_seconds(10)
+            self._revoke_token()
+        finally:
+            timeutils.clear_time_override()
+
+        data = self._revocation_list()
+        self.assertEqual(len(data['revoked']), 2)
+        self.assertEqual(data['until'],
+                         timeutils.isotime(start - datetime.timedelta(
+                             seconds=50)))
+
+        since = timeutils.isotime(start + datetime.timedelta(seconds=5))
+        delta = self._revocation_list(since)
+        self.assertEqual(len(delta['revoked']), 1)
+        # the cursor never goes back
+        self.assertEqual(delta['until'], since)
+
+        # revocations within the overlap are listed again
+        self.assertEqual(self._revocation_list(data['until'])['revoked'],
+                         data['revoked'])
+
+    def test_revocation_list_out_of_order(self):
+        """Revocations stamped before the cursor are still listed."""
+        self.opt_in_group('token', revocation_list_overlap=60)
+        start = timeutils.utcnow().replace(microsecond=0)
+        timeutils.set_time_override(start)
+        try:
+            self._revoke_token()
+            data = self._revocation_list()
+            # revoked by a process whose clock is 30 seconds behind
+            timeutils.set_time_override(
+                start - datetime.timedelta(seconds=30))
+            self._revoke_token()
+            timeutils.set_time_override(start + datetime.timedelta(seconds=1))
+            delta = self._revocation_list(data['until'])
+        finally:
+            timeutils.clear_time_override()
+
+        revoked_ids = set(t['id'] for t in data['revoked'])
+        self.assertEqual(len(delta['revoked']), 2)
+        self.assertEqual(len([t for t in delta['revoked']
+                              if t['id'] not in revoked_ids]), 1)
+
+    def test_revocation_filter(self):
+        self._revoke_token()
+        response = self.api.revocation_filter({'is_admin': True})
+        etag = response.headers['ETag']
+        bloom = utils.BloomFilter.from_bytes(
+            base64.b64decode(json.loads(response.body)['signed']))
+        self.assertEqual(bloom.count, 1)
+
+        context = {'is_admin': True, 'headers': {'If-None-Match': etag}}
+        response = self.api.revocation_filter(context)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(len(self.signed), 1)
+
+        self._revoke_token()
+        response = self.api.revocation_filter(context)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(self.signed), 2)
+
+    def test_revocation_list_since_invalid(self):
+        context = {'is_admin': True, 'query_string': {'since': 'yesterday'}}
+        self.assertRaises(exception.ValidationError,
+                          self.api.revocation_list, context)
+
+
+class VerifiedTokenCacheTest(TokenControllerTest):
+    def setUp(self):
+        super(VerifiedTokenCacheTest, self).setUp()
+        self.token_id = 'MII' + uuid.uuid4().hex
+        expires = timeutils.utcnow() + datetime.timedelta(minutes=5)
+        self.access = {'token': {'id': self.token_id,
+                                 'expires': timeutils.isotime(expires),
+                                 'tenant': {'id': 'BAR'}},
+                       'user': {'id': 'FOO'},
+                       'metadata': {}}
+        self.verified = []
+
+        def fake_verify(formatted, signing_cert_file_name, ca_file_name):
+            self.verified.append(formatted)
+            return json.dumps({'access': self.access})
+        self.stubs.Set(cms, 'cms_verify', fake_verify)
+
+    def test_verified_token_is_cached(self):
+        context = {'is_admin': True}
+        token_ref = self.api._get_token_ref(context, self.token_id, 'BAR')
+        self.assertEqual(token_ref['user'], {'id': 'FOO'})
+        token_ref['user'] = None
+        token_ref = self.api._get_token_ref(context, self.token_id, 'BAR')
+        self.assertEqual(token_ref['user'], {'id': 'FOO'})
+        self.assertEqual(len(self.verified), 1)
+
+    def test_expired_token_is_verified_again(self):
+        context = {'is_admin': True}
+        self.api._get_token_ref(context, self.token_id)
+        timeutils.set_time_override(
+            timeutils.utcnow() + datetime.timedelta(minutes=6))
+        try:
+            self.api._get_token_ref(context, self.token_id)
+        finally:
+            timeutils.clear_time_override()
+        self.assertEqual(len(self.verified), 2)
+
+    def test_revoked_token_is_rejected(self):
+        context = {'is_admin': True}
+        self.api._get_token_ref(context, self.token_id)
+
+        token_hash = cms.cms_hash_token(self.token_id)
+        self.api.token_api.create_token(context, token_hash,
+                                        {'id': token_hash,
+                                         'user': self.access['user']})
+        self.api.token_api.delete_token(context, token_hash)
+        self.assertRaises(exception.TokenNotFound,
+                          self.api._get_token_ref, context, self.token_id)
+
+
+class PkizTokenTest(TokenControllerTest):
+    def test_authenticate_and_validate(self):
+        self.opt_in_group('signing', token_format='PKIZ')
+        body_dict = _build_user_auth(username='FOO', password='foo2',
+                                     tenant_name='BAR')
+        token_ref = self.api.authenticate({}, body_dict)
+        token_id = token_ref['access']['token']['id']
+        self.assertTrue(cms.is_pkiz_token(token_id))
+
+        token_ref = self.api._get_token_ref({'is_admin': True}, token_id,
+                                            'bar')
+        self.assertEqual(token_ref['user']['name'], 'FOO')
+
+    def test_invalid_token(self):
+        self.assertRaises(exception.TokenNotFound,
+                          self.api._get_token_ref, {'is_admin': True},
+                          cms.PKIZ_PREFIX + 'invalid')
+
+
+class ReuseTokenTest(TokenControllerTest):
+    def setUp(self):
+        super(ReuseTokenTest, self).setUp()
+        self.opt_in_group('signing', token_format='UUID')
+        self.opt_in_group('token', reuse=True)
+
+    def _authenticate(self, **kwargs):
+        body_dict = _build_user_auth(username='FOO', password='foo2',
+                                     **kwargs)
+        return self.api.authenticate({}, body_dict)
+
+    def test_token_is_reused(self):
+        token_data = self._authenticate(tenant_name='BAR')
+        self.stubs.Set(self.api.token_api, 'create_token', None)
+        reused_data = self._authenticate(tenant_name='BAR')
+        self.assertEqual(reused_data['access']['token']['id'],
+                         token_data['access']['token']['id'])
+        self.assertEqualTokens(reused_data, token_data)
+
+    def test_reuse_is_opt_in(self):
+        self.opt_in_group('token', reuse=False)
+        token_data = self._authenticate(tenant_name='BAR')
+        self.assertNotEqual(
+            self._authenticate(tenant_name='BAR')['access']['token']['id'],
+            token_data['access']['token']['id'])
+
+    def test_other_tenant_is_not_reused(self):
+        token_data = self._authenticate()
+        scoped_data = self._authenticate(tenant_name='BAR')
+        self.assertNotEqual(scoped_data['access']['token']['id'],
+                            token_data['access']['token']['id'])
+        self.assertEqual(self._authenticate()['access']['token']['id'],
+                         token_data['access']['token']['id'])
+
+    def test_expiring_token_is_not_reused(self):
+        self.opt_in_group('token', reuse_min_lifetime=86400)
+        token_data = self._authenticate(tenant_name='BAR')
+        self.assertNotEqual(
+            self._authenticate(tenant_name='BAR')['access']['token']['id'],
+            token_data['access']['token']['id'])
+
+    def test_revoked_token_is_not_reused(self):
+        token_data = self._authenticate(tenant_name='BAR')
+        self.api.token_api.delete_token({},
+                                        token_data['access']['token']['id'])
+        self.assertNotEqual(
+            self._authenticate(tenant_name='BAR')['access']['token']['id'],
+            token_data['access']['token']['id'])
+
+
+class SqlReuseTokenTest(ReuseTokenTest):
+    def setUp(self):
+        super(SqlReuseTokenTest, self).setUp()
+        self.config([test.etcdir('keystone.conf.sample'),
+                     test.testsdir('test_overrides.conf'),
+                     test.testsdir('backend_sql.conf')])
+        self.opt_in_group('signing', token_format='UUID')
+        self.opt_in_group('token', reuse=True)
+        self.load_backends()
+        self.load_fixtures(default_fixtures)
+        self.api = service.TokenController()
+
+    def tearDown(self):
+        sql.set_global_engine(None)
+        super(SqlReuseTokenTest, self).tearDown()
+
+
+class AdminCacheTest(TokenControllerTest):
+    def setUp(self):
+        super(AdminCacheTest, self).setUp()
+        self.opt_in_group('policy', admin_cache_size=10)
+        self.stubs.Set(wsgi, '_ADMIN_CACHE', None)
+        self.enforced = []
+        enforce = self.api.policy_api.enforce
+
+        def fake_enforce(context, creds, action, target):
+            self.enforced.append(action)
+            return enforce(context, creds, action, target)
+        self.stubs.Set(self.api.policy_api, 'enforce', fake_enforce)
+
+    def _create_token(self, metadata):
+        token_id = uuid.uuid4().hex
+        self.api.token_api.create_token(
+            {}, token_id,
+            {'id': token_id, 'user': {'id': 'FOO'}, 'tenant': {'id': 'BAR'},
+             'metadata': metadata,
+             'expires': timeutils.utcnow() + datetime.timedelta(minutes=5)})
+        return token_id
+
+    def test_admin_token_is_cached(self):
+        context = {'is_admin': False,
+                   'token_id': self._create_token({'is_admin': '1'})}
+        self.api.assert_admin(context)
+        self.api.assert_admin(context)
+        self.assertEqual(len(self.enforced), 1)
+
+        self.api.token_api.delete_token({}, context['token_id'])
+        self.assertRaises(exception.Unauthorized,
+                          self.api.assert_admin, context)
+
+    def test_cached_token_expires(self):
+        context = {'is_admin': False,
+                   'token_id': self._create_token({'is_admin': '1'})}
+        self.api.assert_admin(context)
+        timeutils.set_time_override(
+            timeutils.utcnow() + datetime.timedelta(minutes=6))
+        try:
+            self.assertRaises(exception.Unauthorized,
+                              self.api.assert_admin, context)
+        finally:
+            timeutils.clear_time_override()
+
+    def test_denied_token_is_not_cached(self):
+        context = {'is_admin': False, 'token_id': self._create_token({})}
+        for x in xrange(2):
+            self.assertRaises(exception.Forbidden,
+                              self.api.assert_admin, context)
+        self.assertEqual(len(self.enforced), 2)
+
+
+class ValidateTokenTest(TokenControllerTest):
+    def setUp(self):
+        super(ValidateTokenTest, self).setUp()
+        self.opt_in_group('signing', token_format='UUID')
+        body_dict = _build_user_auth(username='FOO', password='foo2',
+                                     tenant_name='BAR')
+        token_ref = self.api.authenticate({}, body_dict)
+        self.token_id = token_ref['access']['token']['id']
+        self.context = {'is_admin': True, 'query_string': {}}
+
+    def _validate(self):
+        token_ref = self.api.validate_token(self.context, self.token_id)
+        del token_ref['access']['token']['issued_at']
+        return token_ref
+
+    def test_validate_uses_stored_roles_and_catalog(self):
+        self.opt_in_group('token', live_validation=True)
+        live_token_ref = self._validate()
+
+        def fail(*args, **kwargs):
+            raise AssertionError('looked up during validation')
+        self.opt_in_group('token', live_validation=False)
+        self.stubs.Set(self.api.identity_api, 'get_role', fail)
+        self.stubs.Set(self.api.identity_api, 'get_roles', fail)
+        self.stubs.Set(self.api.catalog_api, 'get_catalog', fail)
+        self.assertEqual(self._validate(), live_token_ref)
+
+    def test_live_validation(self):
+        self.opt_in_group('token', live_validation=True)
+        lookups = []
+
+        def get_catalog(*args, **kwargs):
+            lookups.append(kwargs)
+            return {}
+        self.stubs.Set(self.api.catalog_api, 'get_catalog', get_catalog)
+        token_ref = self._validate()
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(token_ref['access']['serviceCatalog'], {})
+
+
+class ValidateTokensTest(TokenControllerTest):
+    def setUp(self):
+        super(ValidateTokensTest, self).setUp()
+        self.opt_in_group('signing', token_format='UUID')
+        self.context = {'is_admin': True, 'query_string': {}}
+
+    def _authenticate(self, tenant_name=None):
+        body_dict = _build_user_auth(username='FOO', password='foo2',
+                                     tenant_name=tenant_name)
+        token_ref = self.api.authenticate({}, body_dict)
+        return token_ref['access']['token']['id']
+
+    def test_validate_tokens(self):
+        scoped = self._authenticate(tenant_name='BAR')
+        unscoped = self._authenticate()
+        deleted = self._authenticate()
+        self.api.delete_token(self.context, deleted)
+        invalid = uuid.uuid4().hex
+
+        results = self.api.validate_tokens(
+            self.context, tokens=[scoped, unscoped, deleted, invalid])
+        results = results['tokens']
+        self.assertEqual(results[deleted], None)
+        self.assertEqual(results[invalid], None)
+        for token_id in (scoped, unscoped):
+            token_ref = self.api.validate_token(self.context, token_id)
+            del token_ref['access']['token']['issued_at']
+            del results[token_id]['access']['token']['issued_at']
+            self.assertEqual(results[token_id], token_ref)
+
+    def test_validate_tokens_belongs_to(self):
+        scoped = self._authenticate(tenant_name='BAR')
+        unscoped = self._authenticate()
+        context = {'is_admin': True, 'query_string': {'belongsTo': 'bar'}}
+        results = self.api.validate_tokens(context,
+                                           tokens=[scoped, unscoped])
+        self.assertNotEqual(results['tokens'][scoped], None)
+        self.assertEqual(results['tokens'][unscoped], None)
+
+    def test_validate_tokens_single_lookup(self):
+        token_ids = [self._authenticate() for i in range(3)]
+        lookups = []
+        get_tokens = self.api.token_api.driver.get_tokens
+
+        def fake_get_tokens(token_ids):
+            lookups.append(token_ids)
+            return get_tokens(token_ids)
+        self.stubs.Set(self.api.token_api.driver, 'get_tokens',
+                       fake_get_tokens)
+        self.api.validate_tokens(self.context, tokens=token_ids)
+        self.assertEqual(lookups, [token_ids])
+
+    def test_validate_tokens_unverifiable_pki_tokens(self):
+        results = self.api.validate_tokens(
+            self.context, tokens=['MII' + uuid.uuid4().hex,
+                                  cms.PKIZ_PREFIX + 'not-a-token'])
+        self.assertEqual(results['tokens'].values(), [None, None])
+
+    def test_validate_tokens_does_not_hide_errors(self):
+        def cms_verify(*args):
+            raise KeyError('signing')
+        self.stubs.Set(cms, 'cms_verify', cms_verify)
+        self.assertRaises(KeyError, self.api.validate_tokens, self.context,
+                          tokens=['MII' + uuid.uuid4().hex])
+
+    def test_validate_tokens_requires_list(self):
+        self.assertRaises(exception.ValidationError,
+                          self.api.validate_tokens, self.context,
+                          tokens='not a list')
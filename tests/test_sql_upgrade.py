@@ -15,6 +15,7 @@
 # under the License.
 
 import copy
+import datetime
 import json
 
 from migrate.versioning import api as versioning_api
@@ -75,6 +76,39 @@ class SqlUpgradeTests(test.TestCase):
         self.assertTableColumns("metadata", ["user_id", "tenant_id", "data"])
         self.populate_user_table()
 
+    def test_upgrade_5_to_6(self):
+        self._migrate(self.repo_path, 5)
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        token_table = sqlalchemy.Table('token', self.metadata, autoload=True)
+        self.engine.execute(token_table.insert().values(
+            id='tok1', expires=expires, valid=True,
+            extra=json.dumps({'user': {'id': 'user1'},
+                              'tenant': {'id': 'tenant1'}})))
+        self.engine.execute(token_table.insert().values(
+            id='tok2', expires=expires, valid=True,
+            extra=json.dumps({'user': {'id': 'user2'}, 'tenant': None})))
+        self.metadata.remove(token_table)
+        self._migrate(self.repo_path, 6)
+        self.assertEqual(self.schema.version, 6)
+        self.assertTableColumns('token',
+                                ['id', 'expires', 'extra', 'valid',
+                                 'user_id', 'tenant_id'])
+        token_table = sqlalchemy.Table('token', self.metadata, autoload=True)
+        rows = self.engine.execute(
+            sqlalchemy.select([token_table.c.id,
+                               token_table.c.user_id,
+                               token_table.c.tenant_id])
+            .order_by(token_table.c.id)).fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+                         [('tok1', 'user1', 'tenant1'),
+                          ('tok2', 'user2', None)])
+
+    def test_upgrade_7_to_8(self):
+        self._migrate(self.repo_path, 8)
+        self.assertTableColumns('token',
+                                ['id', 'expires', 'extra', 'valid',
+                                 'user_id', 'tenant_id', 'revoked_at'])
+
     def populate_user_table(self):
         for user in default_fixtures.USERS:
             extra = copy.deepcopy(user)
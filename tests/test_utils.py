@@ -29,7 +29,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import sys
+
 from keystone.common import utils
+from keystone.common import workers
+from keystone.openstack.common import timeutils
 from keystone import test
 
 
@@ -63,3 +68,127 @@ class UtilsTestCase(test.TestCase):
         self.assertFalse(utils.auth_str_equal('a', 'aaaaa'))
         self.assertFalse(utils.auth_str_equal('aaaaa', 'a'))
         self.assertFalse(utils.auth_str_equal('ABC123', 'abc123'))
+
+
+class LRUCacheTestCase(test.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(),
+                         {'hits': 3, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def test_entries_expire(self):
+        cache = utils.LRUCache(2)
+        now = timeutils.utcnow()
+        cache.set('a', 1, expires=now + datetime.timedelta(seconds=10))
+        self.assertEqual(cache.get('a'), 1)
+        timeutils.set_time_override(now + datetime.timedelta(seconds=10))
+        try:
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(len(cache), 0)
+        finally:
+            timeutils.clear_time_override()
+
+    def test_delete_and_clear(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 0)
+
+
+class BloomFilterTestCase(test.TestCase):
+    def test_members_are_found(self):
+        bloom = utils.BloomFilter(100, 0.01)
+        members = ['member-%d' % x for x in xrange(100)]
+        for member in members:
+            self.assertTrue(bloom.add(member))
+        self.assertFalse(bloom.add(members[0]))
+        self.assertEqual(bloom.count, 100)
+        self.assertTrue(bloom.is_full())
+        for member in members:
+            self.assertIn(member, bloom)
+        false_positives = len([x for x in xrange(1000)
+                               if 'other-%d' % x in bloom])
+        self.assertLess(false_positives, 50)
+
+    def test_serialization(self):
+        bloom = utils.BloomFilter(10)
+        bloom.add('a')
+        loaded = utils.BloomFilter.from_bytes(bloom.to_bytes())
+        self.assertEqual((loaded.num_bits, loaded.num_hashes, loaded.count),
+                         (bloom.num_bits, bloom.num_hashes, 1))
+        self.assertIn('a', loaded)
+        self.assertNotIn('b', loaded)
+
+    def test_invalid_serialization(self):
+        self.assertRaises(ValueError, utils.BloomFilter.from_bytes, 'abc')
+        self.assertRaises(ValueError, utils.BloomFilter.from_bytes,
+                          utils.BloomFilter(10).to_bytes()[:-1])
+
+
+class CryptPoolTestCase(test.TestCase):
+    def setUp(self):
+        super(CryptPoolTestCase, self).setUp()
+        self.opt(crypt_pool_size=1, crypt_strength=1000)
+        self.stubs.Set(utils, '_CRYPT_POOL', None)
+
+    def tearDown(self):
+        utils.crypt_pool().close()
+        super(CryptPoolTestCase, self).tearDown()
+
+    def test_hash_and_check_password(self):
+        # only the workers may hash
+        self.stubs.Set(utils, '_crypt', None)
+        hashed = utils.hash_password(u'p\xe4ssword')
+        self.assertIsInstance(hashed, str)
+        self.assertTrue(utils.check_password(u'p\xe4ssword', hashed))
+        self.assertFalse(utils.check_password('password', hashed))
+
+    def test_failed_worker_falls_back(self):
+        pool = utils.crypt_pool()
+        self.stubs.Set(pool._pool, '_spawn', None)
+        hashed = utils.hash_password('password')
+        self.assertTrue(utils.check_password('password', hashed))
+
+    def test_hung_worker_is_replaced(self):
+        hashed = utils._crypt('hash', 'password', 1000)
+        pool = utils.crypt_pool()._pool
+        pool.timeout = 0.5
+        spawn = pool._spawn
+        spawned = []
+
+        def hang_once():
+            spawned.append(True)
+            if len(spawned) == 1:
+                pipes = workers._subprocess()
+                return pipes.Popen(['sleep', '60'],
+                                   stdin=pipes.PIPE,
+                                   stdout=pipes.PIPE)
+            return spawn()
+        self.stubs.Set(pool, '_spawn', hang_once)
+        self.assertRaises(workers.WorkerError, pool.submit,
+                          ['verify', u'password', hashed])
+
+        # the only worker thread is free again, with a new worker
+        pool.timeout = 10
+        self.assertTrue(pool.submit(['verify', u'password', hashed]))
+        self.assertEqual(len(spawned), 2)
+
+    def test_worker_python(self):
+        self.assertEqual(workers._python(), sys.executable)
+        self.opt(worker_python='/nonexistent/python')
+        self.assertEqual(workers._python(), '/nonexistent/python')
+        self.assertRaises(workers.WorkerError, utils.crypt_pool()._pool.submit,
+                          ['verify', u'password', 'hash'])
@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Compares the throughput of the CMS engines.
+
+Signs and verifies a token sized document with every available engine,
+one at a time and from concurrent threads, as keystone serves requests
+(only the pool engine signs on several cores at once). Then compares the
+size and cost of PKI and PKIZ tokens for service catalogs of increasing
+size, using the example PKI:
+
+    python tools/cms_benchmark.py [iterations]
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from keystone.common import cms
+
+
+SIGNING_CERT = os.path.join(ROOT, 'examples/pki/certs/signing_cert.pem')
+SIGNING_KEY = os.path.join(ROOT, 'examples/pki/private/signing_key.pem')
+CA = os.path.join(ROOT, 'examples/pki/certs/cacert.pem')
+THREADS = 8
+
+
+def _rate(iterations, f, *args):
+    start = time.time()
+    for i in xrange(iterations):
+        f(*args)
+    return iterations / (time.time() - start)
+
+
+def _concurrent_rate(iterations, threads, f, *args):
+    def run():
+        for i in xrange(iterations // threads):
+            f(*args)
+    workers = [threading.Thread(target=run) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (iterations // threads) * threads / (time.time() - start)
+
+
+def _catalog(services, regions=3):
+    catalog = []
+    for i in range(services):
+        endpoints = []
+        for region in range(regions):
+            url = 'https://region%d.example.com:%d/v2/%s' % (
+                region, 8000 + i, '8f3c0d0e9ae04c7e9bd9de1d3e8e6a14')
+            endpoints.append({'region': 'Region%d' % region,
+                              'publicURL': url,
+                              'internalURL': url.replace('https', 'http'),
+                              'adminURL': url.replace('v2', 'admin')})
+        catalog.append({'name': 'service%d' % i,
+                        'type': 'type%d' % i,
+                        'endpoints': endpoints,
+                        'endpoints_links': []})
+    return catalog
+
+
+def main(iterations):
+    with open(os.path.join(ROOT, 'examples/pki/cms/auth_token_scoped.json')) \
+            as f:
+        text = json.dumps(json.load(f))
+
+    signed = {}
+    for name in sorted(cms.ENGINES):
+        try:
+            engine = cms.ENGINES[name]()
+        except ImportError, e:
+            print '%-10s unavailable: %s' % (name, e)
+            continue
+        signed[name] = engine.sign(text, SIGNING_CERT, SIGNING_KEY)
+        sign_rate = _rate(iterations, engine.sign,
+                          text, SIGNING_CERT, SIGNING_KEY)
+        verify_rate = _rate(iterations, engine.verify,
+                            signed[name], SIGNING_CERT, CA)
+        concurrent_rate = _concurrent_rate(iterations, THREADS, engine.sign,
+                                           text, SIGNING_CERT, SIGNING_KEY)
+        print '%-10s sign: %8.1f/s  verify: %8.1f/s  ' \
+              'sign from %d threads: %8.1f/s' % (
+                  name, sign_rate, verify_rate, THREADS, concurrent_rate)
+        engine.close()
+
+    if len(set(signed.values())) > 1:
+        print 'WARNING: the engines produced different signatures'
+
+    cms.set_engine('subprocess')
+    for services in (5, 15, 30):
+        token = json.loads(text)
+        token['access']['serviceCatalog'] = _catalog(services)
+        catalog_text = json.dumps(token)
+        for name, sign, to_cms in (
+                ('PKI', cms.cms_sign_token, cms.token_to_cms),
+                ('PKIZ', cms.pkiz_sign, cms.pkiz_to_cms)):
+            token_id = sign(catalog_text, SIGNING_CERT, SIGNING_KEY)
+            sign_rate = _rate(iterations, sign,
+                              catalog_text, SIGNING_CERT, SIGNING_KEY)
+            verify_rate = _rate(iterations, lambda: cms.cms_verify(
+                to_cms(token_id), SIGNING_CERT, CA))
+            print '%2d services %-4s %6d bytes  sign: %8.1f/s  ' \
+                  'verify: %8.1f/s' % (services, name, len(token_id),
+                                       sign_rate, verify_rate)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)